@@ -1,59 +1,231 @@
+import copy
 import dpkt
+import struct
 
+from dpkt.ethernet import ETH_TYPE_8021Q, ETH_TYPE_IP, Ethernet
+from dpkt.ip import IP_PROTO_TCP
 from dpkt.tcp import *
 from tcp_util import *
 
+# Unpackers for the header fields read by the header-only decoding path
+# (Ethernet type, 802.1Q encapsulated type, IPv4 header, fixed TCP header)
+ETH_HEADER = struct.Struct("!12xH")
+VLAN_HEADER = struct.Struct("!2xH")
+IP_HEADER = struct.Struct("!BxH5xB2x4s4s")
+TCP_HEADER = struct.Struct("!HHIIBB")
+
+ETH_HEADER_LEN = 14
+VLAN_HEADER_LEN = 4
+IP_HEADER_LEN = 20
+TCP_HEADER_LEN = 20
+
+# Raw option buffers consisting of a timestamp option only (optionally preceded
+# by two NOPs for alignment), which is the case for most packets
+TIMESTAMP_ONLY_OPTS = (chr(TCP_OPT_NOP) * 2 + chr(TCP_OPT_TIMESTAMP) + chr(10),
+                       chr(TCP_OPT_TIMESTAMP) + chr(10))
+
 
 class AnnotatedPacket(object):
+    """A TCP packet with the header fields needed by the analysis and the
+    state inferred for it. Attributes are kept in slots since a trace can hold
+    millions of packets (see README for the memory used per packet)"""
+
+    __slots__ = (
+        "_packet", "_buf", "_frame", "_data_offset",
+        "src", "dst", "sport", "dport", "flags", "_raw_opts", "_opts",
+        "data_len", "seq", "seq_end", "ack",
+        "timestamp_us", "index", "ack_delay_ms", "ack_index",
+        "rtx", "rtx_is_spurious", "previous_tx",
+        "seq_relative", "ack_relative")
 
     def __init__(self, packet, timestamp_us, index):
-        self.packet = packet
+        ip = packet.ip
+        tcp = ip.tcp
+
+        self._packet = packet
+        self._buf = self._frame = None
+        self._data_offset = -1
+        self.set_header_fields(ip.src, ip.dst, tcp.sport, tcp.dport, tcp.seq,
+                               tcp.ack, tcp.flags, tcp_data_len(self),
+                               tcp.opts)
+        self.set_initial_state(timestamp_us, index)
+
+    @classmethod
+    def from_headers(cls, buf, timestamp_us, index, src, dst, sport, dport,
+                     seq, ack, flags, data_len, opts):
+        """Creates a packet from header fields that were read directly from the
+        raw frame. The full dpkt packet is only decoded when accessed"""
+        annotated_packet = cls.__new__(cls)
+        annotated_packet._packet = annotated_packet._frame = None
+        annotated_packet._buf = buf
+        annotated_packet._data_offset = -1
+        annotated_packet.set_header_fields(src, dst, sport, dport, seq, ack,
+                                           flags, data_len, opts)
+        annotated_packet.set_initial_state(timestamp_us, index)
+        return annotated_packet
+
+    def set_header_fields(self, src, dst, sport, dport, seq, ack, flags,
+                          data_len, raw_opts):
+        self.src = src
+        self.dst = dst
+        self.sport = sport
+        self.dport = dport
+        self.flags = flags
+        # Options are parsed on first access (see opts)
+        self._raw_opts = raw_opts
+        self._opts = None
+
+        self.data_len = data_len
+        self.seq = seq
+        self.seq_end = add_offset(self.seq, self.data_len)
+        self.ack = ack
+
+    def set_initial_state(self, timestamp_us, index):
         self.timestamp_us = timestamp_us
         self.index = index
         self.ack_delay_ms = -1
         self.ack_index = -1
 
+        # Positions of the retransmission of this packet and of the previous
+        # transmission of its data in the packet list of the endpoint that
+        # transmitted them (None if there is none). Positions are used rather
+        # than references so that packets do not form reference cycles
         self.rtx = None
         self.rtx_is_spurious = False
         self.previous_tx = None
-        self.previous_packet = None
-
-        self.data_len = tcp_data_len(self)
-        self.seq = packet.ip.tcp.seq
-        self.seq_end = add_offset(self.seq, self.data_len)
-
-        # Replace raw option buffer by a parsed version
-        self.packet.ip.tcp.opts = parse_opts(self.packet.ip.tcp.opts)
-
-        self.ack = packet.ip.tcp.ack
 
         # Relative sequence numbers are set by the TCP endpoint
         # (requires knowledge about the initial sequence numbers)
         self.seq_relative = -1
         self.ack_relative = -1
 
-        # Bytes that were received successfully by the other endpoint
-        # (packets transmitted before this one)
-        self.bytes_passed = -1
+    @property
+    def packet(self):
+        """The dpkt ethernet frame carrying this packet (decoded on first access
+        if the packet was created from its header fields only, or copied from
+        the frame it was split from)"""
+        if self._packet is None:
+            if self._frame is not None:
+                packet = copy.deepcopy(self._frame)
+            else:
+                packet = Ethernet(self._buf)
+                if self._opts is not None:
+                    packet.ip.tcp.opts = self._opts
+            self._packet = packet
+            if self._data_offset != -1:
+                self.trim_packet(self._data_offset)
+            self._buf = self._frame = None
+        return self._packet
+
+    def wire_segment(self, offset, data_len):
+        """Returns a packet carrying data_len bytes of this packet's payload
+        starting at the given offset (used when splitting a jumbo packet into
+        smaller on-the-wire frames). The header fields and the frame are shared
+        with this packet, the segment's own frame is only created when
+        accessed"""
+        segment = AnnotatedPacket.__new__(AnnotatedPacket)
+        segment._packet = None
+        segment._buf = self._buf
+        segment._frame = self._packet
+        segment._data_offset = offset
+        segment.set_header_fields(self.src, self.dst, self.sport, self.dport,
+                                  add_offset(self.seq, offset), self.ack,
+                                  self.flags, data_len, self._raw_opts)
+        segment._opts = self._opts
+        segment.set_initial_state(self.timestamp_us, self.index)
+        return segment
+
+    @property
+    def opts(self):
+        """The parsed TCP options as a list of (kind, data) tuples. The options
+        are parsed on first access (the dpkt frame, if decoded, then carries
+        the parsed version as well)"""
+        if self._opts is None:
+            self._opts = parse_opts(self._raw_opts)
+            if self._packet is not None:
+                self._packet.ip.tcp.opts = self._opts
+        return self._opts
+
+    def has_options_besides_timestamp(self):
+        """Quick check (without parsing the options) whether the packet may
+        carry options other than a timestamp, e.g. SACK blocks"""
+        raw_opts = self._raw_opts
+        if len(raw_opts) == 12:
+            return raw_opts[:4] != TIMESTAMP_ONLY_OPTS[0]
+        if len(raw_opts) == 10:
+            return raw_opts[:2] != TIMESTAMP_ONLY_OPTS[1]
+        return len(raw_opts) != 0
 
     def is_lost(self):
         return self.rtx is not None and not self.rtx_is_spurious
 
-    def update_length_and_offset(self, new_length, offset):
-        """Update the sequence numbers and payload length (used when splitting
-        a jumbo packet into smaller on-the-wire frames"""
-        self.data_len = new_length
-        tcp_set_data_len(self, new_length)
+    def trim_packet(self, offset):
+        """Applies the current sequence number and payload length to the dpkt
+        packet, dropping the payload before the given offset"""
+        tcp_set_data_len(self, self.data_len)
         assert self.data_len == tcp_data_len(self)
 
-        tcp = self.packet.ip.tcp
-        self.seq = tcp.seq = add_offset(self.seq, offset)
-        self.seq_end = add_offset(self.seq, self.data_len)
+        tcp = self._packet.ip.tcp
+        tcp.seq = self.seq
 
         # trim buffer storing actual payload
         if len(tcp.data) <= offset:
             tcp.data = []
         else:
             buf_start = offset
-            buf_end = min(len(tcp.data), offset + new_length)
+            buf_end = min(len(tcp.data), offset + self.data_len)
             tcp.data = tcp.data[buf_start:buf_end]
+
+
+def parse_headers(buf):
+    """Reads the TCP/IP header fields of the packet carried in the ethernet frame
+    from their fixed offsets. Returns the source and destination address and
+    port, sequence and ACK number, flags, payload length, and raw option buffer,
+    or None if the frame does not have the usual layout of an IP/TCP packet"""
+    frame_len = len(buf)
+    if frame_len < ETH_HEADER_LEN:
+        return None
+    eth_type = ETH_HEADER.unpack_from(buf)[0]
+    ip_offset = ETH_HEADER_LEN
+    if eth_type == ETH_TYPE_8021Q and frame_len >= ip_offset + VLAN_HEADER_LEN:
+        eth_type = VLAN_HEADER.unpack_from(buf, ip_offset)[0]
+        ip_offset += VLAN_HEADER_LEN
+    if eth_type != ETH_TYPE_IP or frame_len < ip_offset + IP_HEADER_LEN:
+        return None
+
+    v_hl, ip_len, proto, src, dst = IP_HEADER.unpack_from(buf, ip_offset)
+    ip_header_len = (v_hl & 0xf) << 2
+    tcp_offset = ip_offset + ip_header_len
+    # As in dpkt, the IP length field bounds the TCP header and options
+    # unless it is zero (TCP segmentation offload)
+    ip_end = frame_len
+    if ip_len:
+        ip_end = min(frame_len, ip_offset + ip_len)
+    if proto != IP_PROTO_TCP or ip_header_len < IP_HEADER_LEN or \
+       ip_end < tcp_offset + TCP_HEADER_LEN:
+        return None
+
+    sport, dport, seq, ack, off_x2, flags = TCP_HEADER.unpack_from(
+        buf, tcp_offset)
+    tcp_header_len = (off_x2 >> 4) << 2
+    if tcp_header_len < TCP_HEADER_LEN:
+        return None
+    opts = buf[tcp_offset + TCP_HEADER_LEN:
+               min(ip_end, tcp_offset + tcp_header_len)]
+    data_len = ip_len - ip_header_len - tcp_header_len
+    return src, dst, sport, dport, seq, ack, flags, data_len, opts
+
+
+def decode_packet(buf, timestamp_us, index):
+    """Creates the annotated version of the TCP packet carried in the ethernet
+    frame by reading the header fields from their fixed offsets. Frames with an
+    unusual layout are decoded by dpkt instead. Raises an AttributeError if the
+    frame does not encapsulate an IP/TCP packet"""
+    headers = parse_headers(buf)
+    if headers is None:
+        return AnnotatedPacket(Ethernet(buf), timestamp_us, index)
+    # The packet keeps a copy of the frame rather than a view into the buffer
+    # it was read from (e.g. a block of the stream reader shared with other
+    # packets), which a long-lived flow would otherwise keep in memory
+    return AnnotatedPacket.from_headers(str(buf), timestamp_us, index,
+                                        *headers)
@@ -0,0 +1,125 @@
+import struct
+import sys
+
+from tcp_flow import *
+
+# Time (in us) a closed flow is kept after its last packet, e.g. to
+# catch the final ACK or a retransmitted FIN
+CLOSE_LINGER_US = 5 * 1000000
+
+# Interval (in us of capture time) between two checks for flows that can
+# be retired
+SWEEP_INTERVAL_US = 1000000
+
+# Packs a port number for the flow key
+PORT = struct.Struct("!H")
+
+
+def get_flow_key(src, dst, sport, dport):
+    """Returns the key of the flow with the given 4-tuple. The key is the same
+    for both directions: the packed address and port of both endpoints, ordered
+    so that the smaller endpoint comes first"""
+    endpoint_1 = src + PORT.pack(sport)
+    endpoint_2 = dst + PORT.pack(dport)
+    if endpoint_1 < endpoint_2:
+        return endpoint_1 + endpoint_2
+    return endpoint_2 + endpoint_1
+
+
+class FlowTable():
+    """Assigns packets to flows based on the 4-tuple. Flows are retired (i.e.
+    removed from the table) once they were closed by a RST or a FIN from both
+    endpoints and did not see any packet for CLOSE_LINGER_US, or once they did
+    not see any packet for the idle timeout (if set). This is checked when the
+    next packet of a flow arrives and periodically for all flows, so that the
+    result does not depend on other flows. A packet opening a new
+    connection on the 4-tuple of an existing flow (see
+    TcpFlow.is_new_connection) retires that flow and starts a new one"""
+
+    def __init__(self, idle_timeout_us=-1):
+        self.idle_timeout_us = idle_timeout_us
+        # Maps the flow key to the flow's index (order of creation) and the flow
+        self.flows = dict()
+        self.num_flows_created = 0
+        self.next_sweep_us = -1
+
+        # Lookup statistics
+        self.num_hits = self.num_misses = 0
+        self.max_num_flows = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def add_packet(self, annotated_packet):
+        """Adds the packet to its flow (creating a new flow if necessary).
+        Returns a list of (flow index, flow) tuples for the flows that were
+        retired"""
+        key = get_flow_key(annotated_packet.src, annotated_packet.dst,
+                           annotated_packet.sport, annotated_packet.dport)
+        entry = self.flows.get(key)
+        retired_flows = []
+        if entry is None:
+            self.num_misses += 1
+        else:
+            self.num_hits += 1
+            # The flow may have expired before this packet even if no sweep
+            # ran in between
+            if entry[1].is_new_connection(annotated_packet) or \
+               self.is_expired(entry[1], annotated_packet.timestamp_us):
+                retired_flows.append(entry)
+                entry = None
+
+        if entry is None:
+            flow = TcpFlow(annotated_packet)
+            self.flows[key] = (self.num_flows_created, flow)
+            self.num_flows_created += 1
+            self.max_num_flows = max(self.max_num_flows, len(self.flows))
+        else:
+            flow = entry[1]
+        flow.add_packet(annotated_packet)
+
+        if annotated_packet.timestamp_us >= self.next_sweep_us:
+            self.next_sweep_us = annotated_packet.timestamp_us + \
+                SWEEP_INTERVAL_US
+            retired_flows.extend(
+                self.retire_flows(annotated_packet.timestamp_us))
+        return retired_flows
+
+    def retire_flows(self, now_us):
+        """Removes the flows that were closed or idle at the given time.
+        Returns a list of (flow index, flow) tuples ordered by flow index"""
+        retired_keys = []
+        for key, (_, flow) in self.flows.iteritems():
+            if self.is_expired(flow, now_us):
+                retired_keys.append(key)
+        return sorted(self.flows.pop(key) for key in retired_keys)
+
+    def is_expired(self, flow, now_us):
+        """Returns True if the flow is to be retired at the given time, i.e.
+        if it was closed or idle for long enough"""
+        idle_time_us = now_us - flow.last_timestamp_us
+        return (flow.is_closed() and idle_time_us >= CLOSE_LINGER_US) or \
+            (self.idle_timeout_us > 0 and idle_time_us >= self.idle_timeout_us)
+
+    def get_table_size(self):
+        """Returns the memory (in bytes) used by the table itself, i.e. the
+        dict, keys and entries but not the flows"""
+        size = sys.getsizeof(self.flows)
+        for key, entry in self.flows.iteritems():
+            size += sys.getsizeof(key) + sys.getsizeof(entry)
+        return size
+
+    def get_stats(self):
+        """Returns a summary of the table size and lookup counters"""
+        return ("flows: %d active, %d max; lookups: %d hits, %d misses, "
+                "%d inserts; table size: %d bytes" % (
+                    len(self.flows), self.max_num_flows, self.num_hits,
+                    self.num_misses, self.num_flows_created,
+                    self.get_table_size()))
+
+    def retire_all_flows(self):
+        """Removes all flows. Returns a list of (flow index, flow) tuples
+        ordered by flow index"""
+        flows = sorted(self.flows.itervalues())
+        self.flows = dict()
+        return flows
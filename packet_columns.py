@@ -0,0 +1,127 @@
+import numpy
+import operator
+
+from tcp_util import add_offset_array
+
+# Number of appended packets that are converted into rows at a time
+CONVERSION_SIZE = 1024
+
+# Smallest and largest number of rows added when the columns run out of space
+# (the capacity doubles in between)
+MIN_CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 1 << 16
+
+# Packet attributes stored in the columns and their types
+COLUMN_TYPES = [
+    ("index", numpy.int64),
+    ("timestamp_us", numpy.int64),
+    ("seq", numpy.int64),
+    ("seq_end", numpy.int64),
+    ("seq_relative", numpy.int64),
+    ("data_len", numpy.int32),
+    ("ack_delay_ms", numpy.int64),
+    ("ack_index", numpy.int64),
+    ("rtx", numpy.bool_),
+    ("rtx_is_spurious", numpy.bool_),
+    ("bytes_passed", numpy.int64),
+]
+
+
+class PacketColumns():
+    """Columnar store of the analysis-relevant attributes of an endpoint's
+    packets (one typed array per attribute, one row per packet). Appended
+    packets are converted into rows a chunk at a time and the arrays grow in
+    chunks, so that whole-array computations can be used instead of iterating
+    over packet objects. The rows hold the state of the packets when they were
+    converted, i.e. the packets are not expected to change afterwards"""
+
+    def __init__(self):
+        self.size = 0
+        self.capacity = 0
+        self.arrays = dict()
+        for name, dtype in COLUMN_TYPES:
+            self.arrays[name] = numpy.empty(0, dtype)
+        # Packets appended but not converted into rows yet
+        self.pending = []
+        # Bytes delivered by all rows, and their prefix sums (see
+        # delivered_bytes, computed on demand)
+        self.bytes_delivered = 0
+        self.delivered = None
+
+    def __len__(self):
+        return self.size + len(self.pending)
+
+    def __getitem__(self, name):
+        """Returns the column (as a view covering the rows only)"""
+        self.convert_pending()
+        return self.arrays[name][:self.size]
+
+    def append(self, packet):
+        self.pending.append(packet)
+        if len(self.pending) >= CONVERSION_SIZE:
+            self.convert_pending()
+
+    def extend(self, packets):
+        self.pending.extend(packets)
+        if len(self.pending) >= CONVERSION_SIZE:
+            self.convert_pending()
+
+    def convert_pending(self):
+        """Adds a row for each pending packet. The end sequence numbers are
+        computed from the sequence numbers and payload lengths, the bytes passed
+        by each row are the bytes delivered by the rows before it"""
+        packets = self.pending
+        if len(packets) == 0:
+            return
+        self.pending = []
+        start = self.size
+        end = start + len(packets)
+        self.reserve(end)
+        for name, _ in COLUMN_TYPES:
+            if name == "rtx":
+                values = [packet.rtx is not None for packet in packets]
+            elif name in ("seq_end", "bytes_passed"):
+                continue
+            else:
+                values = map(operator.attrgetter(name), packets)
+            self.arrays[name][start:end] = values
+        self.size = end
+
+        arrays = self.arrays
+        arrays["seq_end"][start:end] = add_offset_array(
+            arrays["seq"][start:end], arrays["data_len"][start:end])
+        lost = arrays["rtx"][start:end] & ~arrays["rtx_is_spurious"][start:end]
+        delivered_len = numpy.where(lost, 0, arrays["data_len"][start:end])
+        bytes_passed = arrays["bytes_passed"][start:end]
+        numpy.cumsum(delivered_len, dtype=numpy.int64, out=bytes_passed)
+        bytes_passed += self.bytes_delivered - delivered_len
+        self.bytes_delivered += int(delivered_len.sum())
+
+    def reserve(self, size):
+        """Grows the arrays (by chunks) until they can hold the given number of
+        rows"""
+        if size <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < size:
+            capacity += min(max(capacity, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+        for name, array in self.arrays.items():
+            new_array = numpy.empty(capacity, array.dtype)
+            new_array[:self.size] = array[:self.size]
+            self.arrays[name] = new_array
+        self.capacity = capacity
+
+    def lost(self):
+        """Returns a boolean array marking the lost packets (see
+        AnnotatedPacket.is_lost)"""
+        return self["rtx"] & ~self["rtx_is_spurious"]
+
+    def delivered_bytes(self):
+        """Returns the prefix sums of the payload of the packets that were not
+        lost, i.e. element i holds the bytes delivered by the rows [0, i)
+        (there is one element more than rows). The bytes delivered by any range
+        of rows are the difference of two elements"""
+        bytes_passed = self["bytes_passed"]
+        if self.delivered is None or len(self.delivered) != self.size + 1:
+            self.delivered = numpy.append(bytes_passed, self.bytes_delivered)
+        return self.delivered
@@ -0,0 +1,517 @@
+import Queue
+import bz2
+import mmap
+import struct
+import subprocess
+import threading
+import zlib
+
+from dpkt.pcap import PMUDPCT_MAGIC, TCPDUMP_MAGIC
+
+# Decompressors for formats not supported by the standard library are optional.
+# Without them, the corresponding command line tool is used instead.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Magic numbers of libpcap files storing nanosecond resolution timestamps
+TCPDUMP_MAGIC_NANO = 0xa1b23c4d
+PMUDPCT_MAGIC_NANO = 0x4d3cb2a1
+
+PCAP_FILE_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD_HEADER_LE = struct.Struct("<IIII")
+PCAP_RECORD_HEADER_BE = struct.Struct(">IIII")
+
+# pcapng block types (the section header block type also serves as the file's
+# magic number)
+PCAPNG_SECTION_HEADER_BLOCK = 0x0A0D0D0A
+PCAPNG_INTERFACE_DESCRIPTION_BLOCK = 1
+PCAPNG_PACKET_BLOCK = 2
+PCAPNG_ENHANCED_PACKET_BLOCK = 6
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_MAGIC = "\x0a\x0d\x0d\x0a"
+
+# Offset of the packet data in (enhanced) packet blocks, and minimum lengths
+# of the blocks read (fixed fields plus the trailing block length)
+PCAPNG_PACKET_DATA_OFFSET = 28
+PCAPNG_MIN_PACKET_BLOCK_LEN = 32
+PCAPNG_MIN_INTERFACE_BLOCK_LEN = 20
+
+# pcapng interface options
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_IF_TSRESOL = 9
+PCAPNG_OPT_IF_TSOFFSET = 14
+
+# Default timestamp resolution of pcapng interfaces (microseconds)
+PCAPNG_DEFAULT_UNITS_PER_SECOND = 1000000
+
+# Timestamp resolutions supported by iter_packets()
+US_PER_SECOND = 1000000
+NS_PER_SECOND = 1000000000
+
+# Magic bytes identifying compressed capture files
+COMPRESSION_MAGIC = [
+    ("\xfd7zXZ\x00", "xz"),
+    ("\x1f\x8b", "gzip"),
+    ("\x28\xb5\x2f\xfd", "zstd"),
+    ("BZh", "bzip2"),
+]
+
+# Command line tools used to decompress formats without an installed module
+DECOMPRESSION_COMMANDS = {
+    "xz": ["xz", "-dc"],
+    "zstd": ["zstd", "-dc"],
+}
+
+# Number of bytes read from the input at a time
+READ_SIZE = 1 << 20
+
+# Maximum number of decompressed chunks buffered ahead of the reader
+DECOMPRESSED_QUEUE_SIZE = 16
+
+
+def parse_file_header(buf):
+    """Parses the libpcap file header. Returns the unpacker for the record
+    headers, the number of timestamp units per second, the snapshot length, and
+    the link type"""
+    if len(buf) < PCAP_FILE_HEADER.size:
+        raise ValueError("invalid tcpdump header")
+
+    magic = PCAP_FILE_HEADER.unpack_from(buf, 0)[0]
+    if magic in (TCPDUMP_MAGIC, TCPDUMP_MAGIC_NANO):
+        record_header = PCAP_RECORD_HEADER_LE
+        file_header = PCAP_FILE_HEADER
+    elif magic in (PMUDPCT_MAGIC, PMUDPCT_MAGIC_NANO):
+        record_header = PCAP_RECORD_HEADER_BE
+        file_header = struct.Struct(">IHHiIII")
+    else:
+        raise ValueError("invalid tcpdump header")
+
+    if magic in (TCPDUMP_MAGIC_NANO, PMUDPCT_MAGIC_NANO):
+        subsecond_units = NS_PER_SECOND
+    else:
+        subsecond_units = US_PER_SECOND
+    _, _, _, _, _, snaplen, linktype = file_header.unpack_from(buf, 0)
+    return record_header, subsecond_units, snaplen, linktype
+
+
+class MmapPcapReader(object):
+    """Reads a classic libpcap file by memory-mapping it and walking the record
+    headers in place. Like dpkt.pcap.Reader, iterating yields (timestamp, buf)
+    tuples. The buffers are read-only views into the mapped file and are not
+    copied (Python 2 mmap objects do not support memoryview, so buffer objects
+    are used instead)"""
+
+    def __init__(self, fileobj):
+        self.name = fileobj.name
+        self.__map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        (self.__record_header, self.__subsecond_units, self.snaplen,
+         self.linktype) = parse_file_header(self.__map)
+
+    def datalink(self):
+        return self.linktype
+
+    def __iter__(self):
+        subsecond_units = float(self.__subsecond_units)
+        for tv_sec, tv_subsec, buf in self.__records():
+            yield (tv_sec + tv_subsec / subsecond_units, buf)
+
+    def iter_packets(self, units_per_second=US_PER_SECOND):
+        """Yields (timestamp, buf, linktype) tuples with integer timestamps in
+        the given units"""
+        subsecond_units = self.__subsecond_units
+        linktype = self.linktype
+        for tv_sec, tv_subsec, buf in self.__records():
+            yield (tv_sec * units_per_second +
+                   tv_subsec * units_per_second // subsecond_units,
+                   buf, linktype)
+
+    def __records(self):
+        data = self.__map
+        record_header = self.__record_header
+        offset = PCAP_FILE_HEADER.size
+        last_header_offset = len(data) - record_header.size
+        while offset <= last_header_offset:
+            tv_sec, tv_subsec, caplen, _ = record_header.unpack_from(
+                data, offset)
+            offset += record_header.size
+            yield tv_sec, tv_subsec, buffer(data, offset, caplen)
+            offset += caplen
+
+    def close(self):
+        self.__map.close()
+
+
+class StreamPcapReader(object):
+    """Reads a classic libpcap file from a stream that does not support seeking
+    (e.g. a decompressed input). The stream is consumed in large blocks and the
+    yielded buffers are views into these blocks"""
+
+    def __init__(self, fileobj):
+        self.name = fileobj.name
+        self.__f = fileobj
+        (self.__record_header, self.__subsecond_units, self.snaplen,
+         self.linktype) = parse_file_header(
+            read_exactly(fileobj, PCAP_FILE_HEADER.size))
+
+    def datalink(self):
+        return self.linktype
+
+    def __iter__(self):
+        subsecond_units = float(self.__subsecond_units)
+        for tv_sec, tv_subsec, buf in self.__records():
+            yield (tv_sec + tv_subsec / subsecond_units, buf)
+
+    def iter_packets(self, units_per_second=US_PER_SECOND):
+        """Yields (timestamp, buf, linktype) tuples with integer timestamps in
+        the given units"""
+        subsecond_units = self.__subsecond_units
+        linktype = self.linktype
+        for tv_sec, tv_subsec, buf in self.__records():
+            yield (tv_sec * units_per_second +
+                   tv_subsec * units_per_second // subsecond_units,
+                   buf, linktype)
+
+    def __records(self):
+        record_header = self.__record_header
+        data = ""
+        offset = 0
+        while True:
+            block = self.__f.read(READ_SIZE)
+            if not block:
+                break
+            # Records can span across blocks, so we keep the unprocessed tail
+            if offset < len(data):
+                data = data[offset:] + block
+            else:
+                data = block
+            offset = 0
+
+            last_header_offset = len(data) - record_header.size
+            while offset <= last_header_offset:
+                tv_sec, tv_subsec, caplen, _ = record_header.unpack_from(
+                    data, offset)
+                record_end = offset + record_header.size + caplen
+                if record_end > len(data):
+                    break
+                yield (tv_sec, tv_subsec,
+                       buffer(data, offset + record_header.size, caplen))
+                offset = record_end
+
+    def close(self):
+        self.__f.close()
+
+
+class PcapngReader(object):
+    """Reads a pcapng file from a stream. Files can contain multiple sections
+    and interfaces, each with its own link type and timestamp resolution.
+    Simple packet blocks are skipped since they do not carry a timestamp"""
+
+    def __init__(self, fileobj):
+        self.name = fileobj.name
+        self.__f = fileobj
+        # (link type, timestamp units per second, timestamp offset in seconds)
+        # for each interface of the current section
+        self.interfaces = []
+
+    def __iter__(self):
+        for timestamp_ns, buf, _ in self.iter_packets(NS_PER_SECOND):
+            yield timestamp_ns / 1E9, buf
+
+    def iter_packets(self, units_per_second=US_PER_SECOND):
+        """Yields (timestamp, buf, linktype) tuples with integer timestamps in
+        the given units. The link type is the one of the capturing interface"""
+        byte_order = None
+        data = ""
+        offset = 0
+        while True:
+            block = self.__f.read(READ_SIZE)
+            if not block:
+                break
+            # Blocks can span across reads, so we keep the unprocessed tail
+            if offset < len(data):
+                data = data[offset:] + block
+            else:
+                data = block
+            offset = 0
+
+            while offset + 12 <= len(data):
+                # The byte order is defined by each section header
+                block_type = struct.unpack_from("<I", data, offset)[0]
+                if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+                    byte_order = get_pcapng_byte_order(data, offset)
+                    self.interfaces = []
+                elif byte_order is None:
+                    raise ValueError("invalid pcapng header")
+                else:
+                    block_type = struct.unpack_from(
+                        byte_order + "I", data, offset)[0]
+                block_len = struct.unpack_from(
+                    byte_order + "I", data, offset + 4)[0]
+                if block_len < 12:
+                    raise ValueError("invalid pcapng block length")
+                if offset + block_len > len(data):
+                    break
+
+                if block_type == PCAPNG_ENHANCED_PACKET_BLOCK or \
+                   block_type == PCAPNG_PACKET_BLOCK:
+                    if block_len < PCAPNG_MIN_PACKET_BLOCK_LEN:
+                        raise ValueError("invalid pcapng block length")
+                    if block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+                        interface_id, ts_high, ts_low, caplen, _ = \
+                            struct.unpack_from(byte_order + "IIIII", data,
+                                               offset + 8)
+                    else:
+                        interface_id, _, ts_high, ts_low, caplen, _ = \
+                            struct.unpack_from(byte_order + "HHIIII", data,
+                                               offset + 8)
+                    if PCAPNG_PACKET_DATA_OFFSET + caplen + 4 > block_len:
+                        raise ValueError("invalid pcapng packet length")
+                    buf = buffer(data, offset + PCAPNG_PACKET_DATA_OFFSET,
+                                 caplen)
+                else:
+                    if block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                        self.interfaces.append(parse_pcapng_interface(
+                            data, offset, block_len, byte_order))
+                    offset += block_len
+                    continue
+                offset += block_len
+
+                if interface_id >= len(self.interfaces):
+                    raise ValueError("invalid pcapng interface id")
+                linktype, interface_units, interface_offset = \
+                    self.interfaces[interface_id]
+                timestamp = ((ts_high << 32) | ts_low) * units_per_second // \
+                    interface_units + interface_offset * units_per_second
+                yield timestamp, buf, linktype
+
+    def close(self):
+        self.__f.close()
+
+
+def get_pcapng_byte_order(data, offset):
+    """Returns the struct byte order prefix of the section whose header block
+    starts at the given offset"""
+    magic = struct.unpack_from("<I", data, offset + 8)[0]
+    if magic == PCAPNG_BYTE_ORDER_MAGIC:
+        return "<"
+    if struct.unpack_from(">I", data, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+        return ">"
+    raise ValueError("invalid pcapng section header")
+
+
+def parse_pcapng_interface(data, offset, block_len, byte_order):
+    """Parses an interface description block. Returns its link type, number of
+    timestamp units per second, and timestamp offset (in seconds)"""
+    if block_len < PCAPNG_MIN_INTERFACE_BLOCK_LEN:
+        raise ValueError("invalid pcapng block length")
+    linktype = struct.unpack_from(byte_order + "H", data, offset + 8)[0]
+    units_per_second = PCAPNG_DEFAULT_UNITS_PER_SECOND
+    ts_offset = 0
+
+    option_offset = offset + 16
+    options_end = offset + block_len - 4
+    while option_offset + 4 <= options_end:
+        code, length = struct.unpack_from(byte_order + "HH", data,
+                                          option_offset)
+        if code == PCAPNG_OPT_ENDOFOPT:
+            break
+        value_offset = option_offset + 4
+        if value_offset + length > options_end:
+            raise ValueError("invalid pcapng option length")
+        if code == PCAPNG_OPT_IF_TSRESOL and length >= 1:
+            tsresol = ord(data[value_offset])
+            if tsresol & 0x80:
+                units_per_second = 2 ** (tsresol & 0x7f)
+            else:
+                units_per_second = 10 ** tsresol
+        elif code == PCAPNG_OPT_IF_TSOFFSET and length >= 8:
+            ts_offset = struct.unpack_from(byte_order + "q", data,
+                                           value_offset)[0]
+        # Option values are padded to 32 bits
+        option_offset = value_offset + ((length + 3) & ~3)
+    return linktype, units_per_second, ts_offset
+
+
+class DecompressingFile(object):
+    """Read-only file-like object returning the decompressed content of a
+    compressed file. Decompression runs in a background thread so that it
+    overlaps with processing the data. read() can return fewer bytes than
+    requested before reaching the end of the file."""
+
+    def __init__(self, fileobj, compression):
+        self.name = fileobj.name
+        self.__chunks = Queue.Queue(DECOMPRESSED_QUEUE_SIZE)
+        self.__chunk = ""
+        self.__offset = 0
+        self.__eof = False
+        self.__error = None
+        # Set when the file is closed to stop the background thread
+        self.__stopped = threading.Event()
+
+        self.__process = None
+        if new_decompressor(compression) is not None:
+            target = self.__decompress
+            args = (fileobj, compression)
+        else:
+            self.__process = subprocess.Popen(
+                DECOMPRESSION_COMMANDS[compression], stdin=fileobj,
+                stdout=subprocess.PIPE)
+            target = self.__read_output
+            args = (self.__process,)
+        self.__thread = threading.Thread(target=target, args=args)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __decompress(self, fileobj, compression):
+        try:
+            decompressor = new_decompressor(compression)
+            while not self.__stopped.is_set():
+                data = fileobj.read(READ_SIZE)
+                if not data:
+                    break
+                # Compressed files can consist of multiple concatenated streams
+                while data and not self.__stopped.is_set():
+                    try:
+                        output = decompressor.decompress(data)
+                    except EOFError:
+                        decompressor = new_decompressor(compression)
+                        continue
+                    if output:
+                        self.__chunks.put(output)
+                    data = getattr(decompressor, "unused_data", "")
+                    if data:
+                        decompressor = new_decompressor(compression)
+        except Exception as e:
+            self.__error = e
+        self.__chunks.put(None)
+
+    def __read_output(self, process):
+        while not self.__stopped.is_set():
+            output = process.stdout.read(READ_SIZE)
+            if not output:
+                break
+            self.__chunks.put(output)
+        if process.wait() != 0 and not self.__stopped.is_set():
+            self.__error = IOError("decompression failed for %s" % self.name)
+        self.__chunks.put(None)
+
+    def close(self):
+        """Stops the decompression (e.g. if the reader stops before the end of
+        the file), terminating the decompression command if there is one"""
+        if self.__stopped.is_set():
+            return
+        self.__stopped.set()
+        if self.__process is not None and self.__process.poll() is None:
+            self.__process.kill()
+        # Unblock the background thread if it waits for space in the queue
+        while self.__thread.is_alive():
+            try:
+                while True:
+                    self.__chunks.get_nowait()
+            except Queue.Empty:
+                pass
+            self.__thread.join(0.01)
+        if self.__process is not None:
+            self.__process.wait()
+            self.__process.stdout.close()
+        self.__chunk = ""
+        self.__offset = 0
+        self.__eof = True
+
+    def peek(self, size):
+        """Returns the next bytes of the file without consuming them"""
+        data = read_exactly(self, size)
+        self.__chunk = data + self.__chunk[self.__offset:]
+        self.__offset = 0
+        return data
+
+    def read(self, size=-1):
+        if self.__offset == len(self.__chunk):
+            if self.__eof:
+                return ""
+            chunk = self.__chunks.get()
+            if chunk is None:
+                self.__eof = True
+                if self.__error is not None:
+                    raise self.__error
+                return ""
+            self.__chunk = chunk
+            self.__offset = 0
+
+        if self.__offset == 0 and (size < 0 or size >= len(self.__chunk)):
+            data = self.__chunk
+        else:
+            end = len(self.__chunk) if size < 0 else self.__offset + size
+            data = self.__chunk[self.__offset:end]
+        self.__offset += len(data)
+        return data
+
+
+def new_decompressor(compression):
+    """Returns a streaming decompressor for the given format or None if the
+    module implementing it is not installed"""
+    if compression == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == "bzip2":
+        return bz2.BZ2Decompressor()
+    if compression == "xz" and lzma is not None:
+        return lzma.LZMADecompressor()
+    if compression == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def get_compression(fileobj):
+    """Returns the compression format of the file based on its magic bytes (or
+    None if the file is not compressed)"""
+    magic = fileobj.read(8)
+    fileobj.seek(0)
+    for prefix, compression in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def read_exactly(fileobj, size):
+    """Reads the given number of bytes unless the end of the file is reached"""
+    data = ""
+    while len(data) < size:
+        block = fileobj.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return data
+
+
+def open_pcap(fileobj, use_mmap=False):
+    """Returns a reader for the libpcap or pcapng capture file. Compressed files
+    are decompressed on the fly. Memory-mapping is only supported for
+    uncompressed libpcap files."""
+    compression = get_compression(fileobj)
+    if compression is None:
+        magic = fileobj.read(len(PCAPNG_MAGIC))
+        fileobj.seek(0)
+        if magic == PCAPNG_MAGIC:
+            return PcapngReader(fileobj)
+        if use_mmap:
+            return MmapPcapReader(fileobj)
+        return StreamPcapReader(fileobj)
+
+    stream = DecompressingFile(fileobj, compression)
+    try:
+        if stream.peek(len(PCAPNG_MAGIC)) == PCAPNG_MAGIC:
+            return PcapngReader(stream)
+        return StreamPcapReader(stream)
+    except Exception:
+        stream.close()
+        raise
@@ -1,4 +1,5 @@
 import dpkt
+import numpy
 
 from tcp_endpoint import *
 from tcp_flow import *
@@ -119,184 +120,230 @@ def get_policing_params_for_endpoint(endpoint, cutoff=0):
     coming from this endpoint. Returns None if no traffic policing
     is detected
 
+    The detection is computed with whole-array operations over the endpoint's
+    columnar packet store (see PolicingDetection)
+
     :type cutoff: int
     :param cutoff: number of lost packets to ignore at the beginning and end when determining the
     boundaries for policing rate computation and detection
 
     :returns: policing parameters (including return code, policing rate, and burst size)
     """
-    # Methodology:
-    # 1. Detect first and last loss
-    first_loss = last_loss = first_loss_no_skip = None
-    skipped = 0
-    for packet in endpoint.packets:
-        if packet.is_lost():
-            if first_loss_no_skip is None:
-                first_loss_no_skip = packet
-            if cutoff == skipped:
-                first_loss = packet
-                break
-            else:
-                skipped += 1
-    if first_loss is None:
-        return PolicingParams(RESULT_INSUFFICIENT_LOSS)
-
-    skipped = 0
-    for packet in reversed(endpoint.packets):
-        if packet == first_loss:
-            break
-        if packet.is_lost():
-            if cutoff == skipped:
-                last_loss = packet
-                break
-            else:
-                skipped += 1
-    if last_loss is None:
-        return PolicingParams(RESULT_INSUFFICIENT_LOSS)
-    if first_loss.seq_relative > LATE_LOSS_THRESHOLD:
-        return PolicingParams(RESULT_LATE_LOSS)
-
-    # 2. Compute goodput between first and last loss (policing rate)
-    policing_rate_bps = goodput_for_range(endpoint, first_loss, last_loss)
-
-    # 2a. Compute the y-intercept for the policing rate slope, i.e. the initial number of tokens
-    #    in the bucket. This value should not be negative, indicating that the connection starts
-    #    with either an empty or (partially) filled bucket.
-    median_rtt_us = endpoint.get_median_rtt_ms() * 1000
-    loss_zero_threshold = ZERO_THRESHOLD_LOSS_RTT_MULTIPLIER * \
-        median_rtt_us * policing_rate_bps / 8E6
-    pass_zero_threshold = ZERO_THRESHOLD_PASS_RTT_MULTIPLIER * \
-        median_rtt_us * policing_rate_bps / 8E6
-    y_intercept = first_loss.seq_relative - (policing_rate_bps * (
-        first_loss.timestamp_us - endpoint.packets[0].timestamp_us) / 8E6)
-    if y_intercept < -pass_zero_threshold:
-        return PolicingParams(RESULT_NEGATIVE_FILL)
-
-    # 3. Iterate through packets starting with the first loss and simulate a policer
-    # starting with an empty token bucket. Tokens are inserted at the policing
-    # rate
-    tokens_available = 0
-    tokens_used = 0
-    tokens_on_loss = []
-    tokens_on_pass = []
-
-    seen_first = seen_first_no_skip = False
-    burst_size = 0
-    inflated_rtt_count = 0
-    all_rtt_count = 0
-    rtts = []
-
-    slices_with_loss = 1
-    slice_end = first_loss.timestamp_us + median_rtt_us
-
-    ignore_index = -1
-    tokens_on_loss_out_of_range = 0
-
-    for packet in endpoint.packets:
-        # We only consider ACK delay values for our RTT distribution if there are no pending losses
-        # that might result in a out-of-order reception delay
-        if packet.rtx is not None:
-            ignore_index = max(ignore_index, packet.ack_index)
-        if packet.rtx is None and packet.ack_delay_ms != - \
-                1 and packet.index > ignore_index:
-            rtts.append(packet.ack_delay_ms)
-
-        if packet == first_loss:
-            seen_first = True
-        if packet == first_loss_no_skip:
-            seen_first_no_skip = True
-        if not seen_first_no_skip:
-            burst_size += packet.data_len
-        if not seen_first:
-            continue
+    return PolicingDetection(endpoint).get_params(cutoff)
+
+
+def get_policing_params_for_cutoffs(endpoint, cutoffs):
+    """Computes parameters of the policer affecting the flow data coming from
+    this endpoint for each of the given cutoffs (see
+    get_policing_params_for_endpoint). The work that does not depend on the
+    cutoff is shared between the runs
 
+    :returns: list of policing parameters (one for each cutoff)
+    """
+    detection = PolicingDetection(endpoint)
+    return [detection.get_params(cutoff) for cutoff in cutoffs]
+
+
+class PolicingDetection():
+    """Policing detection over the columnar packet store of an endpoint. The
+    state that does not depend on the cutoff (losses, bytes passed, burst size,
+    median RTT and RTT inflation before each loss) is computed once and shared
+    by the runs for different cutoffs"""
+
+    def __init__(self, endpoint):
+        columns = endpoint.get_columns()
+        self.columns = columns
+        self.timestamps = columns["timestamp_us"]
+        self.lost = columns.lost()
+        self.loss_positions = numpy.flatnonzero(self.lost)
+        self.delivered = columns.delivered_bytes()
+        self.endpoint = endpoint
+
+        self.burst_size = 0
+        if len(self.loss_positions) > 0:
+            self.burst_size = int(
+                columns["data_len"][:self.loss_positions[0]].sum())
+        self.median_rtt_us = endpoint.get_median_rtt_ms() * 1000
+
+        # Whether the RTT inflated before each loss (computed on demand, see
+        # count_inflated_rtts)
+        self.inflated_rtts = None
+
+    def get_params(self, cutoff=0):
+        """Runs the detection for the given cutoff (see
+        get_policing_params_for_endpoint)"""
+        loss_positions = self.loss_positions
+        timestamps = self.timestamps
+
+        # 1. Detect first and last loss (the last loss has to come after the
+        #    first one, so at least 2 * cutoff + 2 losses are needed)
+        if len(loss_positions) < 2 * cutoff + 2:
+            return PolicingParams(RESULT_INSUFFICIENT_LOSS)
+        first_loss = int(loss_positions[cutoff])
+        last_loss = int(loss_positions[-1 - cutoff])
+        first_loss_seq = int(self.columns["seq_relative"][first_loss])
+        first_loss_us = int(timestamps[first_loss])
+        if first_loss_seq > LATE_LOSS_THRESHOLD:
+            return PolicingParams(RESULT_LATE_LOSS)
+
+        # 2. Compute goodput between first and last loss (policing rate)
+        policing_rate_bps = goodput_for_positions(self.endpoint, first_loss,
+                                                  last_loss)
+
+        # 2a. Compute the y-intercept for the policing rate slope, i.e. the
+        #     initial number of tokens in the bucket. This value should not be
+        #     negative, indicating that the connection starts with either an
+        #     empty or (partially) filled bucket.
+        median_rtt_us = self.median_rtt_us
+        loss_zero_threshold = ZERO_THRESHOLD_LOSS_RTT_MULTIPLIER * \
+            median_rtt_us * policing_rate_bps / 8E6
+        pass_zero_threshold = ZERO_THRESHOLD_PASS_RTT_MULTIPLIER * \
+            median_rtt_us * policing_rate_bps / 8E6
+        y_intercept = first_loss_seq - (policing_rate_bps * (
+            first_loss_us - int(timestamps[0])) / 8E6)
+        if y_intercept < -pass_zero_threshold:
+            return PolicingParams(RESULT_NEGATIVE_FILL)
+
+        # 3. Simulate a policer starting with an empty token bucket at the
+        # first loss. Tokens are produced at the policing rate and used by each
+        # packet passing through (the tokens available to a packet do not
+        # include its own)
+        tail_lost = self.lost[first_loss:]
         tokens_produced = policing_rate_bps * \
-            (packet.timestamp_us - first_loss.timestamp_us) / 1E6 / 8
+            (timestamps[first_loss:] - first_loss_us) / 1E6 / 8
+        tokens_used = self.delivered[first_loss:-1] - \
+            self.delivered[first_loss]
         tokens_available = tokens_produced - tokens_used
-
-        if packet.is_lost():
-            tokens_on_loss.append(tokens_available)
-            if (len(rtts) > 1 and rtts[-2] >= percentile(rtts, 50)
-                    and rtts[-2] > INFLATED_RTT_THRESHOLD *
-                        percentile(rtts, INFLATED_RTT_PERCENTILE)
-                    and rtts[-2] >= 20):
-                inflated_rtt_count += 1
-            all_rtt_count += 1
-            if packet.timestamp_us > slice_end:
-                slice_end = packet.timestamp_us + median_rtt_us
+        tokens_on_loss = tokens_available[tail_lost]
+        tokens_on_pass = tokens_available[~tail_lost]
+
+        # Losses within the same RTT (after the first loss of the slice) are
+        # counted as one
+        slices_with_loss = 1
+        slice_end = first_loss_us + median_rtt_us
+        for timestamp_us in timestamps[loss_positions[cutoff:]].tolist():
+            if timestamp_us > slice_end:
+                slice_end = timestamp_us + median_rtt_us
                 slices_with_loss += 1
-        else:
-            tokens_on_pass.append(tokens_available)
-            tokens_used += packet.data_len
-
-    if slices_with_loss < MIN_NUM_SLICES_WITH_LOSS:
-        return PolicingParams(RESULT_INSUFFICIENT_LOSS)
-
-    if len(tokens_on_loss) < MIN_NUM_SAMPLES or len(
-            tokens_on_pass) < MIN_NUM_SAMPLES:
-        return PolicingParams(RESULT_INSUFFICIENT_LOSS)
-
-    # 4. Match observations to expected policing behavior
-    #    (loss iff exceeding policing rate)
-    # a. There are more tokens available when packets pass through compared to
-    # loss
-    if mean(tokens_on_loss) >= mean(tokens_on_pass) or \
-       median(tokens_on_loss) >= median(tokens_on_pass):
-        return PolicingParams(RESULT_HIGHER_FILL_ON_LOSS)
-
-    # b. Token bucket is (roughly) empty when experiencing loss, i.e.
-    #    packets are dropped due to a lack of tokens.
-    #    To account for possible imprecisions regarding the timestamps when the token bucket
-    # was empty, we subtract the median fill level on loss from all token
-    # count samples.
-    median_tokens_on_loss = median(tokens_on_loss)
-    out_of_range = 0
-    for tokens in tokens_on_loss:
-        if abs(tokens - median_tokens_on_loss) > loss_zero_threshold:
-            out_of_range += 1
-    if len(tokens_on_loss) * ZERO_THRESHOLD_LOSS_OUT_OF_RANGE < out_of_range:
-        return PolicingParams(RESULT_LOSS_FILL_OUT_OF_RANGE)
-
-    # c. Token bucket is NOT empty when packets go through, i.e.
-    #    the number of estimated tokens in the bucket should not be overly negative
-    #    To account for possible imprecisions regarding the timestamps when the token bucket
-    # was empty, we subtract the median fill level on loss from all token
-    # count samples.
-    out_of_range = 0
-    for tokens in tokens_on_pass:
-        if tokens - median_tokens_on_loss < -pass_zero_threshold:
-            out_of_range += 1
-    if len(tokens_on_pass) * ZERO_THRESHOLD_PASS_OUT_OF_RANGE < out_of_range:
-        return PolicingParams(RESULT_PASS_FILL_OUT_OF_RANGE)
-
-    # d. RTT did not inflate before loss events
-    rtt_threshold = INFLATED_RTT_TOLERANCE * all_rtt_count
-    # print "threshold: %d, count: %d" % (rtt_threshold, inflated_rtt_count)
-    if inflated_rtt_count > rtt_threshold:
-        return PolicingParams(RESULT_INFLATED_RTT)
-
-    return PolicingParams(RESULT_OK, policing_rate_bps, burst_size)
-
-
-def goodput_for_range(endpoint, first_packet, last_packet):
-    """Computes the goodput (in bps) achieved between observing two specific packets"""
-    if first_packet == last_packet or \
-       first_packet.timestamp_us == last_packet.timestamp_us:
+
+        if slices_with_loss < MIN_NUM_SLICES_WITH_LOSS:
+            return PolicingParams(RESULT_INSUFFICIENT_LOSS)
+
+        if len(tokens_on_loss) < MIN_NUM_SAMPLES or len(
+                tokens_on_pass) < MIN_NUM_SAMPLES:
+            return PolicingParams(RESULT_INSUFFICIENT_LOSS)
+
+        # 4. Match observations to expected policing behavior
+        #    (loss iff exceeding policing rate)
+        # a. There are more tokens available when packets pass through compared
+        # to loss
+        if mean(tokens_on_loss) >= mean(tokens_on_pass) or \
+           median(tokens_on_loss) >= median(tokens_on_pass):
+            return PolicingParams(RESULT_HIGHER_FILL_ON_LOSS)
+
+        # b. Token bucket is (roughly) empty when experiencing loss, i.e.
+        #    packets are dropped due to a lack of tokens.
+        #    To account for possible imprecisions regarding the timestamps when
+        #    the token bucket was empty, we subtract the median fill level on
+        #    loss from all token count samples.
+        median_tokens_on_loss = median(tokens_on_loss)
+        out_of_range = numpy.count_nonzero(
+            numpy.abs(tokens_on_loss - median_tokens_on_loss) >
+            loss_zero_threshold)
+        if len(tokens_on_loss) * ZERO_THRESHOLD_LOSS_OUT_OF_RANGE < \
+           out_of_range:
+            return PolicingParams(RESULT_LOSS_FILL_OUT_OF_RANGE)
+
+        # c. Token bucket is NOT empty when packets go through, i.e.
+        #    the number of estimated tokens in the bucket should not be overly
+        #    negative (again relative to the median fill level on loss)
+        out_of_range = numpy.count_nonzero(
+            tokens_on_pass - median_tokens_on_loss < -pass_zero_threshold)
+        if len(tokens_on_pass) * ZERO_THRESHOLD_PASS_OUT_OF_RANGE < \
+           out_of_range:
+            return PolicingParams(RESULT_PASS_FILL_OUT_OF_RANGE)
+
+        # d. RTT did not inflate before loss events
+        all_rtt_count = len(loss_positions) - cutoff
+        rtt_threshold = INFLATED_RTT_TOLERANCE * all_rtt_count
+        if self.count_inflated_rtts(cutoff) > rtt_threshold:
+            return PolicingParams(RESULT_INFLATED_RTT)
+
+        return PolicingParams(RESULT_OK, policing_rate_bps, self.burst_size)
+
+    def count_inflated_rtts(self, cutoff):
+        """Returns the number of losses (ignoring the first cutoff losses)
+        preceded by an inflated RTT"""
+        if self.inflated_rtts is None:
+            self.inflated_rtts = self.find_inflated_rtts()
+        return sum(self.inflated_rtts[cutoff:])
+
+    def find_inflated_rtts(self):
+        """Returns a list holding whether the RTT inflated before each loss.
+        RTT samples are the ACK delays of packets that were not retransmitted,
+        taken only if no earlier retransmitted packet was ACKed after them
+        (pending losses)"""
+        columns = self.columns
+        retransmitted = columns["rtx"]
+        ack_delays = columns["ack_delay_ms"]
+        ignore_index = numpy.maximum.accumulate(
+            numpy.where(retransmitted, columns["ack_index"], -1))
+        is_rtt_sample = ~retransmitted & (ack_delays != -1) & \
+            (columns["index"] > ignore_index)
+        rtts = ack_delays[is_rtt_sample].tolist()
+        # Number of samples taken up to each loss
+        num_rtts = numpy.cumsum(is_rtt_sample)[self.loss_positions]
+
+        # Samples taken up to the current loss
+        rtts_before_loss = OrderStatistics(rtts)
+        inflated_rtts = []
+        for num_samples in num_rtts.tolist():
+            inflated = False
+            if num_samples >= 2 and rtts[num_samples - 2] >= 20:
+                rtt = rtts[num_samples - 2]
+                for sample in rtts[len(rtts_before_loss):num_samples]:
+                    rtts_before_loss.add(sample)
+                inflated = rtt >= rtts_before_loss.percentile(50) and \
+                    rtt > INFLATED_RTT_THRESHOLD * \
+                    rtts_before_loss.percentile(INFLATED_RTT_PERCENTILE)
+            inflated_rtts.append(inflated)
+        return inflated_rtts
+
+
+def goodput_for_positions(endpoint, first_position, last_position):
+    """Computes the goodput (in bps) achieved between observing the packets at
+    two positions of the endpoint's packet list, i.e. the bytes delivered by
+    the packets from the first position up to (excluding) the last one. Takes
+    constant time using the prefix sums of the delivered bytes (see
+    PacketColumns.delivered_bytes)"""
+    columns = endpoint.get_columns()
+    timestamps = columns["timestamp_us"]
+    time_us = int(timestamps[last_position]) - int(timestamps[first_position])
+    if first_position == last_position or time_us == 0:
         return 0
 
-    byte_count = 0
-    seen_first = False
-    for packet in endpoint.packets:
-        if packet == last_packet:
-            break
-        if packet == first_packet:
-            seen_first = True
-        if not seen_first:
-            continue
-
-        # Packet contributes to goodput if it was not retransmitted
-        if not packet.is_lost():
-            byte_count += packet.data_len
-
-    time_us = last_packet.timestamp_us - first_packet.timestamp_us
+    # No packets are counted if the first position is after the last one
+    if first_position > last_position:
+        byte_count = 0
+    else:
+        delivered = columns.delivered_bytes()
+        byte_count = int(delivered[last_position] - delivered[first_position])
     return byte_count * 8 * 1E6 / time_us
+
+
+def goodput_for_windows(endpoint, window_us):
+    """Computes the goodput (in bps) in consecutive windows of window_us (e.g.
+    the median RTT) starting with the endpoint's first packet, using the prefix
+    sums of the delivered bytes. Returns an array with an element for each
+    window up to the one holding the last packet (packets are assumed to be
+    in capture order)"""
+    columns = endpoint.get_columns()
+    timestamps = columns["timestamp_us"]
+    if len(timestamps) == 0:
+        return numpy.empty(0)
+
+    num_windows = int((timestamps[-1] - timestamps[0]) // window_us) + 1
+    window_bounds = timestamps[0] + numpy.arange(num_windows + 1) * window_us
+    positions = numpy.searchsorted(timestamps, window_bounds)
+    delivered = columns.delivered_bytes()[positions]
+    return numpy.diff(delivered) * 8 * 1E6 / window_us
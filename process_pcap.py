@@ -4,8 +4,10 @@
 #
 # This engine dissects the packets stored in a PCAP file by first assigning each
 # packet to a flow based on the 4-tuple (source/destination IP address and
-# port). There is NO handling for 4-tuple reuse, e.g. when a connection is
-# properly terminated and new connection is established using the same 4-tuple.
+# port). When a 4-tuple is reused, e.g. when a connection is terminated and a
+# new connection is established using the same 4-tuple, a new flow is started
+# on the new connection's SYN (or on a jump in the sequence numbers if the SYN
+# was not captured).
 #
 # Each flow is then divided into segments, where a segment is defined as data
 # from endpoint A followed by data from endpoint B (i.e. a typical
@@ -20,7 +22,8 @@
 # Policing results is composed of multiple columns, where the first two columns
 # correspond to the analysis using all losses, and the other two columns
 # correspond to the analysis ignoring the first and last two losses (i.e.
-# cutoff=2).
+# cutoff=2). Other cutoffs can be selected with --cutoffs, producing two columns
+# per cutoff.
 #
 # The policing results are structured as follows:
 # <Is policed?>,[<result code>,<policing rate>,<data before first loss>]
@@ -36,11 +39,37 @@
 # generated usually includes two lines total (one per direction, there is only
 # one segment) with policing only detectable for the server-to-client flow (i.e.
 # direction "b2a").
+#
+# Multiple input files can be analyzed in a single run (the output format stays
+# the same). Inputs can be files, directories (searched recursively for
+# capture files), glob patterns, or "-" to read a list of file names from
+# stdin. With --jobs, files are distributed across multiple processes. The
+# output still follows the order of the input files unless --unordered is given.
+# With --shards, the flows of each file are distributed across multiple
+# processes instead, which helps with large captures holding many flows.
+#
+# Flows are analyzed as soon as they are closed (RST or FIN from both endpoints)
+# or, with --idle-timeout, idle, so that memory usage depends on the number of
+# concurrent flows rather than on the size of the file. Flow indices are
+# assigned in the order in which the flows' first packets appear in the input
+# file.
 
+import argparse
 import dpkt
+import gc
+import glob
+import multiprocessing
+import os
+import Queue
+import struct
 import sys
+import traceback
+import zlib
 
+from dpkt.pcap import DLT_EN10MB
 from annotated_packet import *
+from flow_table import *
+from pcap_reader import *
 from policing_detector import *
 from tcp_flow import *
 from tcp_segment import *
@@ -49,51 +78,138 @@ from tcp_util import *
 # Maximum number of packets that will be handled overall (NOT per flow)
 MAX_NUM_PACKETS = -1
 
-if len(sys.argv) < 2:
-    print "Missing parameter(s)"
-    print "Usage: python %s <input file>" % (sys.argv[0])
-    exit(-1)
+# Numbers of losses ignored at the beginning and end of each segment by the
+# detection runs reported for each segment and direction (see
+# get_policing_params_for_endpoint)
+DEFAULT_CUTOFFS = [0, 2]
+
+# File name extensions of capture files picked up when searching directories
+# (optionally followed by a compression extension)
+CAPTURE_EXTENSIONS = (".pcap", ".pcapng", ".cap")
+COMPRESSION_EXTENSIONS = ("", ".xz", ".gz", ".zst", ".bz2")
+
+# Number of frames sent to a shard process at a time, and maximum number of
+# batches queued for each shard process
+SHARD_BATCH_SIZE = 1000
+SHARD_QUEUE_SIZE = 64
+
+# Seconds to wait for a shard process's queue before checking whether the
+# process is still running
+SHARD_POLL_INTERVAL = 1
+
+# Errors reading or decoding an input file, reported for the file without
+# aborting the analysis of the others
+INPUT_ERRORS = (EnvironmentError, ValueError, struct.error, dpkt.UnpackError)
+
+
+def is_capture_filename(filename):
+    for capture_extension in CAPTURE_EXTENSIONS:
+        for compression_extension in COMPRESSION_EXTENSIONS:
+            if filename.endswith(capture_extension + compression_extension):
+                return True
+    return False
 
-input_filename = sys.argv[1]
-input_file = open(input_filename)
-pcap = dpkt.pcap.Reader(input_file)
 
-flows = dict()
-index = 0
-for ts, buf in pcap:
-    eth = dpkt.ethernet.Ethernet(buf)
+def get_input_filenames(inputs):
+    """Expands the input arguments (files, directories, glob patterns, or "-"
+    to read file names from stdin) into the list of files to analyze"""
+    filenames = []
+    for name in inputs:
+        if name == "-":
+            filenames.extend(line.strip() for line in sys.stdin
+                             if line.strip() != "")
+        elif os.path.isdir(name):
+            for directory, _, files in sorted(os.walk(name)):
+                filenames.extend(os.path.join(directory, filename)
+                                 for filename in sorted(files)
+                                 if is_capture_filename(filename))
+        elif not os.path.exists(name) and glob.has_magic(name):
+            filenames.extend(sorted(glob.glob(name)))
+        else:
+            filenames.append(name)
+    return filenames
 
+
+def read_frames(input_filename, use_mmap=False):
+    """Yields the timestamp (in us) and buffer of each ethernet frame stored in
+    the capture file"""
+    input_file = open(input_filename, "rb")
     try:
-        # Convert TCP packet to an annotated version
-        # This can fail, e.g. if the ethernet frame does not encapsulate a
-        # IP/TCP packet
-        ts_us = int(ts * 1E6)
-        annotated_packet = AnnotatedPacket(eth, ts_us, index)
-    except AttributeError:
-        continue
-
-    # Add packet to a flow based on the 4-tuple
-    ip = annotated_packet.packet.ip
-    key_1 = (ip.src, ip.dst, ip.tcp.sport, ip.tcp.dport)
-    key_2 = (ip.dst, ip.src, ip.tcp.dport, ip.tcp.sport)
-    if key_1 in flows:
-        flows[key_1].add_packet(annotated_packet)
-    elif key_2 in flows:
-        flows[key_2].add_packet(annotated_packet)
-    else:
-        flows[key_1] = TcpFlow(annotated_packet)
-        flows[key_1].add_packet(annotated_packet)
+        pcap = open_pcap(input_file, use_mmap)
+        try:
+            for ts_us, buf, linktype in pcap.iter_packets():
+                if linktype == DLT_EN10MB:
+                    yield ts_us, buf
+        finally:
+            # Also stops the decompression if the caller stops reading early
+            pcap.close()
+    finally:
+        input_file.close()
+
+
+def decode_frame(buf, ts_us, index, fast_decode=False):
+    """Converts the TCP packet carried in the frame to an annotated version.
+    This can fail with an AttributeError, e.g. if the ethernet frame does not
+    encapsulate a IP/TCP packet"""
+    if fast_decode:
+        return decode_packet(buf, ts_us, index)
+    return AnnotatedPacket(dpkt.ethernet.Ethernet(buf), ts_us, index)
+
+
+def read_flows(input_filename, use_mmap=False, fast_decode=False,
+               idle_timeout_us=-1, flow_stats=False):
+    """Reads the capture file and assigns its TCP packets to flows. Yields
+    (flow index, flow) tuples as soon as flows are retired from the flow table
+    (i.e. closed or idle), followed by the flows still active at the end of the
+    file. The flow table statistics are written to stderr if flow_stats is
+    set"""
+    flow_table = FlowTable(idle_timeout_us)
+    index = 0
+
+    # Packets and flows do not form reference cycles and are freed by reference
+    # counting. The cyclic garbage collector is paused while reading since it
+    # would repeatedly scan the growing set of packets (but not while the
+    # caller handles the retired flows)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for ts_us, buf in read_frames(input_filename, use_mmap):
+            try:
+                annotated_packet = decode_frame(buf, ts_us, index,
+                                                fast_decode)
+            except AttributeError:
+                continue
+            retired_flows = flow_table.add_packet(annotated_packet)
+            if retired_flows:
+                if gc_enabled:
+                    gc.enable()
+                for retired_flow in retired_flows:
+                    yield retired_flow
+                gc.disable()
 
-    # We are only looking the first thousand or so packets so we can abort
-    # processing an excessive number of packets in the input file
-    index += 1
-    if MAX_NUM_PACKETS != -1 and index > MAX_NUM_PACKETS:
-        break
+            # We are only looking the first thousand or so packets so we can
+            # abort processing an excessive number of packets in the input
+            # file
+            index += 1
+            if MAX_NUM_PACKETS != -1 and index > MAX_NUM_PACKETS:
+                break
+    finally:
+        if gc_enabled:
+            gc.enable()
 
-input_file.close()
+    if flow_stats:
+        print >> sys.stderr, "%s: %s" % (input_filename,
+                                         flow_table.get_stats())
+    for retired_flow in flow_table.retire_all_flows():
+        yield retired_flow
 
-flow_index = 0
-for _, flow in flows.items():
+
+def analyze_flow(flow, cutoffs=DEFAULT_CUTOFFS):
+    """Runs the policing detection on each segment and direction of the flow
+    for each cutoff. Returns a (segment index, direction, number of data
+    packets, number of losses, policing results) tuple for each segment and
+    direction"""
+    results = []
     flow.post_process()
 
     # Split flow into segments
@@ -111,30 +227,375 @@ for _, flow in flows.items():
                 data_endpoint = segment.endpoint_b
 
             policing_str = ""
-            for cutoff in [0, 2]:
-                policing_params = get_policing_params_for_endpoint(
-                    data_endpoint, cutoff)
+            for policing_params in get_policing_params_for_cutoffs(
+                    data_endpoint, cutoffs):
                 policing_str += ",%s,%s" % (policing_params.result_code ==
                                             RESULT_OK, policing_params.__repr__())
             num_data_packets = data_endpoint.num_data_packets
             num_losses = data_endpoint.num_losses()
-
-            # print output format:
-            # 1. input file name
-            # 2. flow index
-            # 3. segment index
-            # 4. direction ("a2b" or "b2a")
-            # 5. number of data packets
-            # 6. number of losses
-            # 7+ policing results
-            print '%s,%d,%d,%s,%d,%d%s' % (
-                input_filename,
-                flow_index,
-                segment_index,
-                direction,
-                num_data_packets,
-                num_losses,
-                policing_str)
+            results.append((segment_index, direction, num_data_packets,
+                            num_losses, policing_str))
 
         segment_index += 1
-    flow_index += 1
+    return results
+
+
+def format_lines(input_filename, flow_index, results):
+    """Returns the output lines for the detection results of a flow"""
+    lines = []
+    for (segment_index, direction, num_data_packets, num_losses,
+         policing_str) in results:
+        # output format:
+        # 1. input file name
+        # 2. flow index
+        # 3. segment index
+        # 4. direction ("a2b" or "b2a")
+        # 5. number of data packets
+        # 6. number of losses
+        # 7+ policing results
+        lines.append('%s,%d,%d,%s,%d,%d%s' % (
+            input_filename,
+            flow_index,
+            segment_index,
+            direction,
+            num_data_packets,
+            num_losses,
+            policing_str))
+    return lines
+
+
+def process_file(input_filename, use_mmap=False, fast_decode=False,
+                 idle_timeout_us=-1, flow_stats=False,
+                 cutoffs=DEFAULT_CUTOFFS):
+    """Analyzes all flows in the capture file. Each flow is analyzed and
+    released once it is retired from the flow table. Yields the output lines"""
+    for flow_index, flow in read_flows(input_filename, use_mmap, fast_decode,
+                                       idle_timeout_us, flow_stats):
+        for line in format_lines(input_filename, flow_index,
+                                 analyze_flow(flow, cutoffs)):
+            yield line
+
+
+def get_flow_shard(src, dst, sport, dport, num_shards):
+    """Maps the 4-tuple of a flow to a shard (the same for both directions)"""
+    key = get_flow_key(src, dst, sport, dport)
+    return (zlib.crc32(key) & 0xffffffff) % num_shards
+
+
+def run_shard(shard, frame_queue, result_queue, fast_decode, idle_timeout_us,
+              cutoffs):
+    """Builds and analyzes the flows of one shard from the batches of
+    (index, timestamp, frame) tuples received through the frame queue. Puts the
+    detection results (along with the index of each flow's first packet), an
+    error message (or None) and the flow table statistics into the result
+    queue, tagged with the shard number"""
+    # Packets and flows do not form reference cycles, the collector only runs
+    # while flows are analyzed (see read_flows)
+    gc.disable()
+    flow_table = FlowTable(idle_timeout_us)
+    flow_results = []
+    error = None
+    while True:
+        batch = frame_queue.get()
+        if batch is None:
+            break
+        # After a failure the queue is still drained so that the front-end
+        # does not block
+        if error is not None:
+            continue
+        try:
+            for index, ts_us, buf in batch:
+                try:
+                    annotated_packet = decode_frame(buf, ts_us, index,
+                                                    fast_decode)
+                except AttributeError:
+                    continue
+                for _, flow in flow_table.add_packet(annotated_packet):
+                    gc.enable()
+                    flow_results.append((flow.packets[0].index,
+                                         analyze_flow(flow, cutoffs)))
+                    gc.disable()
+        except Exception:
+            error = traceback.format_exc().strip()
+
+    stats = flow_table.get_stats()
+    gc.enable()
+    if error is None:
+        try:
+            for _, flow in flow_table.retire_all_flows():
+                flow_results.append((flow.packets[0].index,
+                                     analyze_flow(flow, cutoffs)))
+        except Exception:
+            error = traceback.format_exc().strip()
+    result_queue.put((shard, (flow_results, error, stats)))
+
+
+def check_shard_process(process):
+    """Raises a ValueError if the shard process terminated abnormally, e.g.
+    when it was killed after running out of memory"""
+    if process.exitcode is None or process.exitcode == 0:
+        return
+    if process.exitcode < 0:
+        raise ValueError("shard process killed by signal %d" %
+                         -process.exitcode)
+    raise ValueError("shard process exited with code %d" % process.exitcode)
+
+
+def put_shard_batch(frame_queue, process, batch):
+    """Puts the batch into the frame queue of the shard process, checking
+    periodically that the process is still running while the queue is full"""
+    while True:
+        try:
+            frame_queue.put(batch, True, SHARD_POLL_INTERVAL)
+            return
+        except Queue.Full:
+            check_shard_process(process)
+
+
+def process_file_sharded(input_filename, num_shards, use_mmap=False,
+                         fast_decode=False, idle_timeout_us=-1,
+                         flow_stats=False, cutoffs=DEFAULT_CUTOFFS):
+    """Analyzes all flows in the capture file using num_shards processes. The
+    file is read once and each TCP packet is sent to the process handling the
+    shard of its flow. Returns the output lines once the whole file has been
+    analyzed (the flows can only be numbered after all shards are done). A
+    shard process terminating abnormally fails the file"""
+    result_queue = multiprocessing.Queue()
+    frame_queues = []
+    processes = []
+    for shard in range(num_shards):
+        frame_queue = multiprocessing.Queue(SHARD_QUEUE_SIZE)
+        process = multiprocessing.Process(
+            target=run_shard,
+            args=(shard, frame_queue, result_queue, fast_decode,
+                  idle_timeout_us, cutoffs))
+        process.daemon = True
+        process.start()
+        frame_queues.append(frame_queue)
+        processes.append(process)
+
+    batches = [[] for _ in range(num_shards)]
+    shard_results = [None] * num_shards
+    index = 0
+    finished = False
+    try:
+        for ts_us, buf in read_frames(input_filename, use_mmap):
+            headers = parse_headers(buf)
+            if headers is None:
+                # Unusual frame layout, let dpkt find the TCP/IP headers
+                try:
+                    annotated_packet = decode_frame(buf, ts_us, index)
+                except AttributeError:
+                    continue
+                headers = (annotated_packet.src, annotated_packet.dst,
+                           annotated_packet.sport, annotated_packet.dport)
+            src, dst, sport, dport = headers[:4]
+
+            shard = get_flow_shard(src, dst, sport, dport, num_shards)
+            batch = batches[shard]
+            batch.append((index, ts_us, str(buf)))
+            if len(batch) == SHARD_BATCH_SIZE:
+                put_shard_batch(frame_queues[shard], processes[shard], batch)
+                batches[shard] = []
+
+            index += 1
+            if MAX_NUM_PACKETS != -1 and index > MAX_NUM_PACKETS:
+                break
+
+        for shard in range(num_shards):
+            if batches[shard]:
+                put_shard_batch(frame_queues[shard], processes[shard],
+                                batches[shard])
+            put_shard_batch(frame_queues[shard], processes[shard], None)
+
+        while None in shard_results:
+            try:
+                shard, shard_result = result_queue.get(True,
+                                                       SHARD_POLL_INTERVAL)
+                shard_results[shard] = shard_result
+            except Queue.Empty:
+                for shard in range(num_shards):
+                    if shard_results[shard] is None:
+                        check_shard_process(processes[shard])
+        finished = True
+    finally:
+        # After a failure (of the file or of a shard process) the remaining
+        # processes are stopped and the frames still queued are discarded
+        for shard in range(num_shards):
+            if not finished:
+                processes[shard].terminate()
+                frame_queues[shard].cancel_join_thread()
+            processes[shard].join()
+
+    flow_results = []
+    errors = []
+    for shard_flow_results, error, stats in shard_results:
+        flow_results.extend(shard_flow_results)
+        if flow_stats:
+            print >> sys.stderr, "%s (shard): %s" % (input_filename, stats)
+        if error is not None:
+            errors.append(error)
+    if errors:
+        raise ValueError("; ".join(errors))
+
+    # Flows are numbered in the order of their first packets, as in the
+    # single-process analysis
+    lines = []
+    for flow_index, (_, results) in enumerate(sorted(flow_results)):
+        lines.extend(format_lines(input_filename, flow_index, results))
+    return lines
+
+
+def analyze_file(input_filename, num_shards=1, use_mmap=False,
+                 fast_decode=False, idle_timeout_us=-1, flow_stats=False,
+                 cutoffs=DEFAULT_CUTOFFS):
+    """Analyzes the capture file, using num_shards processes if num_shards is
+    larger than 1. Returns an iterable over the output lines"""
+    if num_shards > 1:
+        return process_file_sharded(input_filename, num_shards, use_mmap,
+                                    fast_decode, idle_timeout_us, flow_stats,
+                                    cutoffs)
+    return process_file(input_filename, use_mmap, fast_decode,
+                        idle_timeout_us, flow_stats, cutoffs)
+
+
+def process_file_task(task):
+    """Runs analyze_file() for an (input filename, keyword arguments) tuple.
+    Returns the input filename, the output lines, and an error message (or None
+    if the file was analyzed successfully)"""
+    input_filename, options = task
+    try:
+        return input_filename, list(analyze_file(input_filename,
+                                                 **options)), None
+    except INPUT_ERRORS as e:
+        return input_filename, [], str(e)
+
+
+def get_file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def process_files(tasks, num_jobs=1, ordered=True):
+    """Analyzes the file of each (input filename, keyword arguments) task.
+    Yields the input filename, the output lines, and an error message (or
+    None) for each file. Files are analyzed in the current process (with
+    output lines generated as the file is read) unless num_jobs is larger than
+    1, in which case a pool of num_jobs processes is used. The results are
+    yielded in the order of the tasks if ordered is set, otherwise as soon as
+    they are completed"""
+    if num_jobs <= 1:
+        for input_filename, options in tasks:
+            # The sharded analysis reads the whole file here rather than when
+            # the lines are consumed
+            try:
+                lines = analyze_file(input_filename, **options)
+            except INPUT_ERRORS as e:
+                yield input_filename, [], str(e)
+                continue
+            yield input_filename, lines, None
+        return
+
+    # Start with the largest files so that the remaining processes are not
+    # left waiting for a single large file at the end
+    schedule = sorted(range(len(tasks)), reverse=True,
+                      key=lambda i: get_file_size(tasks[i][0]))
+    pool = multiprocessing.Pool(num_jobs)
+    if ordered:
+        pending_results = [None] * len(tasks)
+        for i in schedule:
+            pending_results[i] = pool.apply_async(process_file_task,
+                                                  (tasks[i],))
+        for pending_result in pending_results:
+            yield pending_result.get()
+    else:
+        for result in pool.imap_unordered(process_file_task,
+                                          [tasks[i] for i in schedule]):
+            yield result
+    pool.close()
+    pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Detects traffic policing in the TCP flow(s) of PCAP files")
+    parser.add_argument("inputs", metavar="<input file>", nargs="+",
+                        help="capture file, directory, glob pattern, or - to "
+                        "read file names from stdin")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory-map the input file and hand packets to "
+                        "the decoder without copying them")
+    parser.add_argument("--fast-decode", action="store_true",
+                        help="read the TCP/IP header fields directly from the "
+                        "frame and only decode the full packet on demand")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of processes analyzing input files in "
+                        "parallel (0 to use all CPUs)")
+    parser.add_argument("--unordered", action="store_true",
+                        help="print the results of each file as soon as it is "
+                        "analyzed instead of in input order")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of processes analyzing the flows of each "
+                        "input file in parallel (0 to use all CPUs)")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="analyze and release flows that did not see a "
+                        "packet for the given number of seconds (closed flows "
+                        "are always released)")
+    parser.add_argument("--flow-stats", action="store_true",
+                        help="write the size and lookup counters of the flow "
+                        "table to stderr for each input file")
+    parser.add_argument("--cutoffs", default=",".join(
+                        str(cutoff) for cutoff in DEFAULT_CUTOFFS),
+                        help="comma-separated numbers of losses to ignore at "
+                        "the beginning and end of each segment, one detection "
+                        "run (and pair of result columns) per number "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    num_jobs = args.jobs
+    if num_jobs == 0:
+        num_jobs = multiprocessing.cpu_count()
+    num_shards = args.shards
+    if num_shards == 0:
+        num_shards = multiprocessing.cpu_count()
+    if num_jobs > 1 and num_shards > 1:
+        parser.error("--jobs and --shards cannot be combined")
+    idle_timeout_us = -1
+    if args.idle_timeout > 0:
+        idle_timeout_us = int(args.idle_timeout * 1E6)
+    try:
+        cutoffs = [int(cutoff) for cutoff in args.cutoffs.split(",")]
+    except ValueError:
+        parser.error("--cutoffs must be a comma-separated list of integers")
+    if any(cutoff < 0 for cutoff in cutoffs):
+        parser.error("--cutoffs must not be negative")
+    options = dict(num_shards=num_shards, use_mmap=args.mmap,
+                   fast_decode=args.fast_decode,
+                   idle_timeout_us=idle_timeout_us,
+                   flow_stats=args.flow_stats, cutoffs=cutoffs)
+    tasks = [(input_filename, options)
+             for input_filename in get_input_filenames(args.inputs)]
+
+    num_failed = 0
+    for input_filename, lines, error in process_files(
+            tasks, num_jobs, not args.unordered):
+        # A broken capture file should not abort the analysis of the others
+        try:
+            for line in lines:
+                print line
+        except INPUT_ERRORS as e:
+            error = str(e)
+        if error is not None:
+            print >> sys.stderr, "Failed to process %s: %s" % (
+                input_filename, error)
+            num_failed += 1
+        sys.stdout.flush()
+
+    if num_failed > 0:
+        exit(-1)
+
+
+if __name__ == "__main__":
+    main()
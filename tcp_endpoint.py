@@ -1,63 +1,159 @@
+import bisect
 import dpkt
 import struct
 import sys
 
 from dpkt.tcp import TCP_OPT_SACK, TH_ACK, TH_SYN
+from packet_columns import *
 from tcp_util import *
 
 
+# Number of acked entries at the front of the unacked packet list that
+# triggers its compaction (if they are at least half of the list)
+UNACKED_COMPACTION_SIZE = 1024
+
+
+class PacketIndex():
+    """Index over packets by their starting sequence number. Maps each
+    starting sequence number to the positions (in the endpoint's packet list)
+    of the packets starting there. The starting sequence numbers are also kept
+    as a sorted list along with the largest payload length seen. Packets with a
+    negative payload length (e.g. frames captured before TCP segmentation
+    offload) do not cover a contiguous range and are kept in a separate list"""
+
+    def __init__(self):
+        self.positions_by_seq = dict()
+        self.seqs = []
+        self.max_data_len = 1
+        self.odd_positions = []
+
+    def add(self, packet, position):
+        if packet.data_len < 0:
+            bisect.insort(self.odd_positions, position)
+            return
+        positions = self.positions_by_seq.get(packet.seq)
+        if positions is None:
+            self.positions_by_seq[packet.seq] = [position]
+            bisect.insort(self.seqs, packet.seq)
+        else:
+            bisect.insort(positions, position)
+        self.max_data_len = max(self.max_data_len, packet.data_len)
+
+    def find(self, seq, packets, matches):
+        """Returns the largest position of a packet carrying the sequence number
+        for which matches(packet) is True, or -1 if there is none"""
+        found_position = -1
+
+        # A packet carries the sequence number if it starts at most its payload
+        # length before it (or exactly at it for packets without payload), so
+        # only packets starting in the last max_data_len sequence numbers are
+        # candidates
+        seq_low = subtract_offset(seq, self.max_data_len - 1)
+        if seq_low <= seq:
+            seq_ranges = [(seq_low, seq)]
+        else:
+            seq_ranges = [(seq_low, 0xFFFFFFFF), (0, seq)]
+        for range_start, range_end in seq_ranges:
+            start = bisect.bisect_left(self.seqs, range_start)
+            end = bisect.bisect_right(self.seqs, range_end)
+            for candidate_seq in self.seqs[start:end]:
+                for position in reversed(self.positions_by_seq[candidate_seq]):
+                    if position <= found_position:
+                        break
+                    if matches(packets[position]):
+                        found_position = position
+                        break
+
+        for position in reversed(self.odd_positions):
+            if position <= found_position:
+                break
+            if matches(packets[position]):
+                found_position = position
+                break
+        return found_position
+
+
 class TcpEndpoint():
 
-    def __init__(self, annotated_packet, use_source):
-        ip = annotated_packet.packet.ip
+    def __init__(self, annotated_packet, use_source, use_columns=False):
         if use_source:
-            self.ip = ip.src
-            self.port = ip.tcp.sport
+            self.ip = annotated_packet.src
+            self.port = annotated_packet.sport
             self.mss = -1
         else:
-            self.ip = ip.dst
-            self.port = ip.tcp.dport
+            self.ip = annotated_packet.dst
+            self.port = annotated_packet.dport
             self.mss = tcp_mss(annotated_packet)
         self.packets = []
+
+        # Packets that were not acked yet, ordered by their unwrapped end
+        # sequence numbers (see unacked_keys). Entries before unacked_start
+        # were acked already and are dropped once they make up a large part of
+        # the list
         self.unacked_packets = []
+        self.unacked_keys = []
+        self.unacked_start = 0
+        self.unacked_reference = 0
         self.num_data_packets = 0
+
+        # Statistics maintained while packets and ACKs are processed: number of
+        # lost packets and RTT samples (ACK delays of packets that were not
+        # retransmitted)
+        self.loss_count = 0
+        self.rtt_samples_ms = SampleCounts()
         self.seq_acked = self.seq_next = self.ack = -1
         self.seq_init = self.ack_init = -1
         self.seq_initialized = False
-        self.median_rtt_ms = None
+
+        # Indexes over the transmitted packets (to find the previous
+        # transmission of retransmitted data) and over the packets that were
+        # retransmitted (to find the packets referred to by DSACKs)
+        self.tx_index = PacketIndex()
+        self.rtx_index = PacketIndex()
+
+        # Endpoints created with use_columns keep their packets only as rows of
+        # a columnar store instead of in the packet list. This is meant for
+        # packets that are added without processing and do not change anymore
+        # (e.g. those of the segments of an analyzed flow). Other endpoints get
+        # a columnar copy of their packets on demand (see get_columns)
+        self.use_columns = use_columns
+        self.columns = None
+        if use_columns:
+            self.columns = PacketColumns()
 
         self.set_initial_sequence_numbers(annotated_packet, use_source)
 
-    def get_median_rtt_ms(self, recompute=False):
-        if self.median_rtt_ms is None or recompute:
-            rtts = []
-            for packet in self.packets:
-                if packet.rtx is None and packet.ack_delay_ms != -1:
-                    rtts.append(packet.ack_delay_ms)
-            self.median_rtt_ms = median(rtts)
-        return self.median_rtt_ms
+    def get_median_rtt_ms(self):
+        return self.rtt_samples_ms.median()
+
+    def add_rtt_sample(self, packet):
+        if packet.rtx is None and packet.ack_delay_ms != -1:
+            self.rtt_samples_ms.add(packet.ack_delay_ms)
+
+    def remove_rtt_sample(self, packet):
+        if packet.rtx is None and packet.ack_delay_ms != -1:
+            self.rtt_samples_ms.remove(packet.ack_delay_ms)
 
     def set_initial_sequence_numbers(self, annotated_packet, use_source=True):
         """Initial state relying on sequence numbers (once negotiated).
         Relative sequence and ACK numbers start at 1"""
-        tcp = annotated_packet.packet.ip.tcp
-        ack_flag_set = tcp.flags & TH_ACK
+        ack_flag_set = annotated_packet.flags & TH_ACK
 
         # Initialize sequence numbers
         if self.seq_init == -1:
             if use_source:
-                self.seq_acked = self.seq_next = tcp.seq
+                self.seq_acked = self.seq_next = annotated_packet.seq
             elif ack_flag_set:
-                self.seq_acked = self.seq_next = tcp.ack
+                self.seq_acked = self.seq_next = annotated_packet.ack
             if self.seq_next != -1:
                 self.seq_init = self.seq_next - 1
 
         # Initialize ACK numbers
         if self.ack_init == -1:
             if use_source and ack_flag_set:
-                self.ack = tcp.ack
+                self.ack = annotated_packet.ack
             elif not use_source:
-                self.ack = tcp.seq
+                self.ack = annotated_packet.seq
             if self.ack != -1:
                 self.ack_init = self.ack - 1
 
@@ -73,7 +169,7 @@ class TcpEndpoint():
         if not self.seq_initialized:
             self.set_initial_sequence_numbers(annotated_packet)
         if process_packet and self.mss == -1:
-            if annotated_packet.packet.ip.tcp.flags & TH_SYN:
+            if annotated_packet.flags & TH_SYN:
                 self.mss = tcp_mss(annotated_packet)
             else:
                 self.mss = tcp_mss_estimate(annotated_packet)
@@ -86,8 +182,6 @@ class TcpEndpoint():
         for packet in wire_packets:
             packet.seq_relative = subtract_offset(packet.seq, self.seq_init)
             packet.ack_relative = subtract_offset(packet.ack, self.ack_init)
-            if self.packets != []:
-                packet.previous_packet = self.packets[-1]
 
             # Update state for packets carrying data
             if packet.seq_end != packet.seq and process_packet:
@@ -96,34 +190,50 @@ class TcpEndpoint():
                 else:
                     # Sequence was transmitted before (-> retransmission)
                     self.find_previous_tx(packet)
-                self.unacked_packets.append(packet)
-            self.packets.append(packet)
+                self.add_unacked(packet)
+            if process_packet:
+                self.tx_index.add(packet, len(self.packets))
+            if self.use_columns:
+                self.columns.append(packet)
+            else:
+                self.packets.append(packet)
 
             if packet.data_len > 0:
                 self.num_data_packets += 1
+            # Packets added without processing (e.g. to segments of an
+            # analyzed flow) may already be lost or acked
+            if packet.is_lost():
+                self.loss_count += 1
+            self.add_rtt_sample(packet)
 
         return wire_packets
 
     def find_previous_tx(self, annotated_packet):
         """Look for the most recent packet that carried (at least) the same starting
         sequence number and mark this packet as its retransmission"""
-        for previous_packet in reversed(self.packets):
-            if (previous_packet.seq == annotated_packet.seq or
-                between(annotated_packet.seq, previous_packet.seq,
-                        previous_packet.seq_end)):
-                previous_packet.rtx = annotated_packet
-                annotated_packet.previous_tx = previous_packet
-                return
+        seq = annotated_packet.seq
+        position = self.tx_index.find(
+            seq, self.packets,
+            lambda packet: packet.seq == seq or
+            between(seq, packet.seq, packet.seq_end))
+        if position != -1:
+            previous_packet = self.packets[position]
+            if previous_packet.rtx is None:
+                self.rtx_index.add(previous_packet, position)
+                self.remove_rtt_sample(previous_packet)
+                self.loss_count += 1
+            # The retransmission is appended to the packet list next
+            previous_packet.rtx = len(self.packets)
+            annotated_packet.previous_tx = position
 
     def process_ack(self, annotated_packet):
         """Process the ACK and possible SACK and DSACK blocks"""
-        tcp = annotated_packet.packet.ip.tcp
         sacks = get_sacks(annotated_packet)
 
         # If the ACK number advanced or if the packet carried SACK blocks
         # we check if unacked packets are now fully acked
-        if after(tcp.ack, self.seq_acked):
-            self.seq_acked = tcp.ack
+        if after(annotated_packet.ack, self.seq_acked):
+            self.seq_acked = annotated_packet.ack
             self.ack_packets(annotated_packet, sacks)
         elif len(sacks) > 0:
             self.ack_packets(annotated_packet, sacks)
@@ -132,17 +242,82 @@ class TcpEndpoint():
         if len(sacks) > 0:
             self.dsack_packets(annotated_packet, sacks)
 
+    def add_unacked(self, packet):
+        """Inserts the packet into the list of unacked packets"""
+        key = unwrap(packet.seq_end, self.unacked_reference)
+        self.unacked_reference = key
+        if not self.unacked_keys or key >= self.unacked_keys[-1]:
+            self.unacked_packets.append(packet)
+            self.unacked_keys.append(key)
+        else:
+            position = bisect.bisect_right(self.unacked_keys, key,
+                                           self.unacked_start)
+            self.unacked_packets.insert(position, packet)
+            self.unacked_keys.insert(position, key)
+
     def ack_packets(self, ack_packet, sacks=[]):
-        """Go through the list of unacked packets and only keep the ones that
-        are still unacked"""
-        remaining_unacked_packets = []
-        for unacked_packet in self.unacked_packets:
-            if not after(unacked_packet.seq_end, self.seq_acked) or \
-                    is_sacked(unacked_packet, sacks):
-                set_ack_params(unacked_packet, ack_packet)
+        """Removes the packets that are now acked (cumulatively or by any of the
+        SACK blocks) from the list of unacked packets"""
+        packets = self.unacked_packets
+        start = self.unacked_start
+        while start < len(packets) and \
+                not after(packets[start].seq_end, self.seq_acked):
+            self.set_ack_params(packets[start], ack_packet)
+            start += 1
+        self.unacked_start = start
+        if start >= UNACKED_COMPACTION_SIZE and 2 * start >= len(packets):
+            del self.unacked_packets[:start]
+            del self.unacked_keys[:start]
+            self.unacked_start = 0
+
+        for sack_start, sack_end in self.get_sack_scoreboard(sacks):
+            self.ack_sacked_packets(ack_packet, sack_start, sack_end)
+
+    def get_sack_scoreboard(self, sacks):
+        """Returns the ranges covered by the SACK blocks as a sorted list of
+        disjoint (start, end) tuples of unwrapped sequence numbers. Overlapping
+        and adjacent blocks are merged. Blocks spanning 2^31 bytes or more
+        (which would exceed any window) are ignored"""
+        ranges = []
+        for sack_start, sack_end in sacks:
+            sack_len = subtract_offset(sack_end, sack_start)
+            if sack_len == 0 or sack_len >= 0x80000000:
+                continue
+            range_start = unwrap(sack_start, self.unacked_reference)
+            ranges.append((range_start, range_start + sack_len))
+        ranges.sort()
+
+        scoreboard = []
+        for range_start, range_end in ranges:
+            if scoreboard and range_start <= scoreboard[-1][1]:
+                if range_end > scoreboard[-1][1]:
+                    scoreboard[-1] = (scoreboard[-1][0], range_end)
             else:
-                remaining_unacked_packets.append(unacked_packet)
-        self.unacked_packets = remaining_unacked_packets
+                scoreboard.append((range_start, range_end))
+        return scoreboard
+
+    def ack_sacked_packets(self, ack_packet, range_start, range_end):
+        """Removes the packets that are fully acked by the SACKed range (in
+        unwrapped sequence numbers) from the list of unacked packets. Only the
+        packets ending within the range are looked at"""
+        start = bisect.bisect_right(self.unacked_keys, range_start,
+                                    self.unacked_start)
+        end = bisect.bisect_right(self.unacked_keys, range_end, start)
+        if start == end:
+            return
+
+        remaining_packets = []
+        remaining_keys = []
+        for position in range(start, end):
+            packet = self.unacked_packets[position]
+            key = self.unacked_keys[position]
+            if range_start <= key - packet.data_len < range_end:
+                self.set_ack_params(packet, ack_packet)
+            else:
+                remaining_packets.append(packet)
+                remaining_keys.append(key)
+        self.unacked_packets[start:end] = remaining_packets
+        self.unacked_keys[start:end] = remaining_keys
 
     def dsack_packets(self, ack_packet, sacks):
         """SACKs with ranges below the current ACK number are DSACKs indicating
@@ -157,45 +332,44 @@ class TcpEndpoint():
     def handle_spurious_rtx(self, seq_start, seq_end):
         """Finds the most recent packet carrying the given sequence range that was
         marked as retransmitted, and add the spurious retransmission tag"""
-        for packet in reversed(self.packets):
-            if packet.rtx is not None and \
-               range_included(seq_start, seq_end, packet.seq, packet.seq_end):
+        position = self.rtx_index.find(
+            seq_start, self.packets,
+            lambda packet: range_included(seq_start, seq_end, packet.seq,
+                                          packet.seq_end))
+        if position != -1:
+            packet = self.packets[position]
+            if not packet.rtx_is_spurious:
                 packet.rtx_is_spurious = True
-                return
+                self.loss_count -= 1
+
+    def set_ack_params(self, packet, ack):
+        """Sets the ACK parameters of one of this endpoint's packets and updates
+        the RTT samples"""
+        self.remove_rtt_sample(packet)
+        set_ack_params(packet, ack)
+        self.add_rtt_sample(packet)
 
     def num_losses(self):
-        count = 0
-        for packet in self.packets:
-            if packet.is_lost():
-                count += 1
-        return count
-
-    def set_passed_bytes_for_packets(self):
-        """Computes the number of bytes already received successfully by the
-        other endpoint (for each packet transmitted by this endpoint; this includes
-        packets that are potentially still in flight while transmitting the current
-        packet"""
-        num_bytes = 0
-        for packet in self.packets:
-            packet.bytes_passed = num_bytes
-            if not packet.is_lost():
-                num_bytes += packet.data_len
-
-
-def is_sacked(packet, sacks):
-    """Returns True if the packet is fully acked by any of the given SACK blocks"""
-    for sack_start, sack_end in sacks:
-        if range_included(packet.seq, packet.seq_end,
-                          sack_start, sack_end):
-            return True
-    return False
+        return self.loss_count
+
+    def get_columns(self):
+        """Returns the columnar store of the packets. Endpoints keeping a packet
+        list return a copy created on first use, which does not reflect
+        packets added or updated afterwards, i.e. it is meant for endpoints
+        that are completely processed (see TcpFlow.post_process)"""
+        if self.columns is None:
+            self.columns = PacketColumns()
+            self.columns.extend(self.packets)
+        return self.columns
 
 
 def get_sacks(ack_packet):
     """Extract the SACK/DSACK ranges if this ACK carries any in its option space"""
     sacks = []
+    if not ack_packet.has_options_besides_timestamp():
+        return sacks
 
-    for option_kind, option_data in ack_packet.packet.ip.tcp.opts:
+    for option_kind, option_data in ack_packet.opts:
         if option_kind == TCP_OPT_SACK:
             sack_data = option_data
             # Each SACK block carries 8 bytes marking the start
@@ -206,9 +380,8 @@ def get_sacks(ack_packet):
                 # packet, but we can still process the trace)
                 return []
 
-            while len(sack_data) > 0:
-                sacks.append(struct.unpack("!II", sack_data[:8]))
-                sack_data = sack_data[8:]
+            edges = struct.unpack("!%dI" % (len(sack_data) / 4), sack_data)
+            sacks = zip(edges[0::2], edges[1::2])
             break
     return sacks
 
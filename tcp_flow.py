@@ -1,34 +1,86 @@
 import dpkt
 
-from dpkt.tcp import TH_ACK
+from dpkt.tcp import TH_ACK, TH_FIN, TH_RST, TH_SYN
 from tcp_endpoint import *
 
+# Largest distance (in bytes) between the sequence number of a packet and the
+# next expected sequence number of its sender that is still considered part of
+# the same connection (the maximum receive window with window scaling)
+MAX_SEQUENCE_JUMP = 1 << 30
+
 
 class TcpFlow():
 
-    def __init__(self, annotated_packet):
-        self.endpoint_a = TcpEndpoint(annotated_packet, True)
-        self.endpoint_b = TcpEndpoint(annotated_packet, False)
+    def __init__(self, annotated_packet, use_columns=False):
+        self.endpoint_a = TcpEndpoint(annotated_packet, True, use_columns)
+        self.endpoint_b = TcpEndpoint(annotated_packet, False, use_columns)
+        # Flows using columns only keep their packets in the columnar stores
+        # of the endpoints (see TcpEndpoint)
+        self.use_columns = use_columns
         self.packets = []
 
+        # Connection teardown state and time of the most recent packet
+        self.fin_from_a = self.fin_from_b = self.reset = False
+        self.last_timestamp_us = annotated_packet.timestamp_us
+
     def add_packet(self, annotated_packet, process_packet=True):
         """Adds a new packet associated with this flow. Both endpoint will use the
         packet to update their internal state if process_packet is set to True."""
-        ip = annotated_packet.packet.ip
-        if self.endpoint_a.ip == ip.src and self.endpoint_a.port == ip.tcp.sport:
-            current_sender = self.endpoint_a
+        current_sender = self.get_sender(annotated_packet)
+        if current_sender == self.endpoint_a:
             current_receiver = self.endpoint_b
         else:
-            current_sender = self.endpoint_b
             current_receiver = self.endpoint_a
 
         wire_packets = current_sender.add_packet(
             annotated_packet, process_packet)
-        self.packets.extend(wire_packets)
+        if not self.use_columns:
+            self.packets.extend(wire_packets)
 
-        if process_packet and ip.tcp.flags & TH_ACK:
+        if process_packet and annotated_packet.flags & TH_ACK:
             current_receiver.process_ack(annotated_packet)
 
+        self.last_timestamp_us = max(self.last_timestamp_us,
+                                     annotated_packet.timestamp_us)
+        if annotated_packet.flags & TH_RST:
+            self.reset = True
+        elif annotated_packet.flags & TH_FIN:
+            if current_sender == self.endpoint_a:
+                self.fin_from_a = True
+            else:
+                self.fin_from_b = True
+
+    def get_sender(self, annotated_packet):
+        if self.endpoint_a.ip == annotated_packet.src and \
+           self.endpoint_a.port == annotated_packet.sport:
+            return self.endpoint_a
+        return self.endpoint_b
+
+    def is_new_connection(self, annotated_packet):
+        """Returns True if the packet belongs to a new connection reusing the
+        4-tuple of this flow, i.e. it is a SYN with a different initial sequence
+        number or its sequence number is far off the sender's sequence space"""
+        sender = self.get_sender(annotated_packet)
+        if sender.seq_init == -1:
+            return False
+        flags = annotated_packet.flags
+        if flags & TH_SYN and not flags & TH_ACK:
+            return annotated_packet.seq != add_offset(sender.seq_init, 1)
+        # Resets may carry an arbitrary sequence number
+        if flags & TH_RST or sender.seq_next == -1:
+            return False
+        return seq_distance(annotated_packet.seq, sender.seq_next) > \
+            MAX_SEQUENCE_JUMP
+
+    def is_closed(self):
+        """Returns True if the connection was reset or both endpoints sent a
+        FIN"""
+        return self.reset or (self.fin_from_a and self.fin_from_b)
+
     def post_process(self):
-        self.endpoint_a.set_passed_bytes_for_packets()
-        self.endpoint_b.set_passed_bytes_for_packets()
+        """Finalizes the flow once all packets were added. The endpoint
+        statistics are maintained while adding packets, only columnar copies
+        of the packets taken before (see TcpEndpoint.get_columns) are dropped
+        since they may be outdated"""
+        if not self.use_columns:
+            self.endpoint_a.columns = self.endpoint_b.columns = None
@@ -8,31 +8,34 @@ def split_flow_into_segments(flow):
     defined by: data only from endpoint A (request) followed by data only from
     endpoint B (response). New data from endpoint A initiates a new segment.
     Returns: list of TcpFlow instances with each instance representing a segment
+    (keeping its packets in columnar stores only)
     """
     segments = []
     if len(flow.packets) == 0:
         return segments
 
     current_sender = flow.endpoint_a
-    current_segment = TcpFlow(flow.packets[0])
+    current_segment = TcpFlow(flow.packets[0], True)
     segments.append(current_segment)
+    segment_started = False
     for packet in flow.packets:
         # Non-data packets do not trigger a new segment
         if packet.data_len == 0:
-            if len(current_segment.packets) > 0:
+            if segment_started:
                 current_segment.add_packet(packet, False)
             continue
 
         # If data comes from the other endpoint: enter response phase or create
         # a new segment
-        ip = packet.packet.ip
-        if current_sender.ip != ip.src or current_sender.port != ip.tcp.sport:
+        if current_sender.ip != packet.src or \
+           current_sender.port != packet.sport:
             if current_sender == flow.endpoint_a:
                 current_sender = flow.endpoint_b
             else:
                 current_sender = flow.endpoint_a
-                current_segment = TcpFlow(packet)
+                current_segment = TcpFlow(packet, True)
                 segments.append(current_segment)
         current_segment.add_packet(packet, False)
+        segment_started = True
 
     return segments
@@ -1,4 +1,3 @@
-import copy
 import numpy
 import struct
 
@@ -56,6 +55,135 @@ def subtract_offset(sequence, offset):
     return new_sequence
 
 
+def unwrap(sequence, reference):
+    """Returns the unwrapped (i.e. not limited to 32 bits) version of the
+    sequence number that is closest to the given unwrapped reference"""
+    return reference + ((sequence - reference + 0x80000000) &
+                        0xFFFFFFFF) - 0x80000000
+
+
+# The array versions of the helpers above come with examples that can be
+# checked with "python -m doctest tcp_util.py"
+
+
+def as_seq_array(sequences):
+    """Converts sequence numbers (arrays or scalars) to int64 so that their
+    differences do not overflow"""
+    return numpy.asarray(sequences, dtype=numpy.int64)
+
+
+def after_array(first, second):
+    """Array version of after() (element-wise with broadcasting)
+
+    >>> seqs = [0, 1, 0x7FFFFFFE, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF]
+    >>> after_array(seqs, 0).tolist()
+    [False, True, True, False, False, False]
+    >>> after_array(0, seqs).tolist()
+    [False, False, False, False, True, True]
+    >>> after_array(seqs, 0).tolist() == [after(seq, 0) for seq in seqs]
+    True
+    """
+    difference = as_seq_array(first) - as_seq_array(second)
+    return (((difference > 0) & (difference < 0x7FFFFFFF)) |
+            ((difference < 0) & (-difference > 0x7FFFFFFF)))
+
+
+def before_array(first, second):
+    """Array version of before()
+
+    >>> before_array([0xFFFFFFF0, 0x10], 0xFFFFFFF8).tolist()
+    [True, False]
+    """
+    return after_array(second, first)
+
+
+def between_array(middle, first, second):
+    """Array version of between()
+
+    >>> between_array([0xFFFFFF00, 0xFFFFFFF0, 0, 5, 10], 0xFFFFFF00,
+    ...               10).tolist()
+    [False, True, True, True, False]
+    """
+    return before_array(first, middle) & after_array(second, middle)
+
+
+def range_included_array(first_start, first_end, second_start, second_end):
+    """Array version of range_included()
+
+    >>> range_included_array([0xFFFFFFF0, 0, 8], [4, 10, 20], 0xFFFFFF00,
+    ...                      10).tolist()
+    [True, True, False]
+    """
+    first_start = as_seq_array(first_start)
+    first_end = as_seq_array(first_end)
+    return (((first_start == second_start) |
+             between_array(first_start, second_start, second_end)) &
+            ((first_end == second_end) |
+             between_array(first_end, second_start, second_end)))
+
+
+def add_offset_array(sequences, offsets):
+    """Array version of add_offset()
+
+    >>> add_offset_array([0xFFFFFFF0, 0x10], 0x20)
+    array([16, 48])
+    """
+    new_sequences = as_seq_array(sequences) + offsets
+    return numpy.where(new_sequences >= 0x100000000,
+                       new_sequences - 0x100000000, new_sequences)
+
+
+def subtract_offset_array(sequences, offsets):
+    """Array version of subtract_offset()
+
+    >>> subtract_offset_array([0x10, 0xFFFFFFFF], 0x20)
+    array([4294967280, 4294967263])
+    """
+    new_sequences = as_seq_array(sequences) - offsets
+    return numpy.where(new_sequences < 0, new_sequences + 0x100000000,
+                       new_sequences)
+
+
+def unwrap_array(sequences, reference):
+    """Array version of unwrap() (all sequence numbers are unwrapped relative
+    to the same reference)
+
+    >>> unwrap_array([0xFFFFFFF0, 0x10], 0x100000000)
+    array([4294967280, 4294967312])
+    """
+    return reference + ((as_seq_array(sequences) - reference + 0x80000000) &
+                        0xFFFFFFFF) - 0x80000000
+
+
+def unwrap_sequence_array(sequences, reference=0):
+    """Unwraps a series of sequence numbers, each one relative to the unwrapped
+    version of the previous one (the first one relative to the reference), i.e.
+    the result of repeatedly calling unwrap() with the previous result as
+    reference. Returns an int64 array
+
+    >>> unwrap_sequence_array([0xFFFFFFF0, 0x10, 0xFFFFFFF8,
+    ...                        0x80000010]).tolist()
+    [-16, 16, -8, -2147483632]
+    >>> unwrap_sequence_array([]).tolist()
+    []
+    """
+    sequences = as_seq_array(sequences)
+    if len(sequences) == 0:
+        return sequences
+    steps = ((numpy.diff(sequences) + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+    unwrapped = numpy.empty(len(sequences), numpy.int64)
+    unwrapped[0] = unwrap(int(sequences[0]), reference)
+    unwrapped[1:] = unwrapped[0] + numpy.cumsum(steps)
+    return unwrapped
+
+
+def seq_distance(first, second):
+    """Returns the absolute distance between two sequence numbers while
+    considering wraparound"""
+    distance = subtract_offset(first, second)
+    return min(distance, 0x100000000 - distance)
+
+
 def tcp_data_len(annotated_packet):
     """Returns the payload length of the TCP packet"""
     ip = annotated_packet.packet.ip
@@ -73,10 +201,9 @@ def tcp_set_data_len(annotated_packet, new_payload_length):
 def tcp_mss(annotated_packet):
     """Returns the maximum segment size (MSS) if defined in a TCP option,
     otherwise -1"""
-    tcp = annotated_packet.packet.ip.tcp
     mss = -1
     timestamp_ok = False
-    for option_kind, option_data in tcp.opts:
+    for option_kind, option_data in annotated_packet.opts:
         if option_kind == TCP_OPT_MSS:
             mss = struct.unpack("!H", option_data)[0]
         if option_kind == TCP_OPT_TIMESTAMP:
@@ -115,18 +242,124 @@ def tcp_wire_packets(annotated_packet, mss):
         return [annotated_packet]
 
     # Split the payload across multiple packets carrying at most MSS bytes
-    # each. Except sequence numbers and data length all other fields are copied
+    # each. Except sequence numbers and data length all other fields are shared
     lst = []
     offset = 0
     while offset < data_len:
         current_data_len = min(mss, data_len - offset)
-        new_packet = copy.deepcopy(annotated_packet)
-        new_packet.update_length_and_offset(current_data_len, offset)
-        lst.append(new_packet)
+        lst.append(annotated_packet.wire_segment(offset, current_data_len))
         offset += current_data_len
     return lst
 
 
+class SampleCounts():
+    """Multiset of samples taking few distinct values (e.g. RTTs in ms), kept
+    as the number of occurrences of each value. Adding and removing a sample
+    takes constant time, the median is computed from the distinct values"""
+
+    def __init__(self):
+        self.counts = dict()
+        self.size = 0
+
+    def add(self, value):
+        self.counts[value] = self.counts.get(value, 0) + 1
+        self.size += 1
+
+    def remove(self, value):
+        count = self.counts[value] - 1
+        if count == 0:
+            del self.counts[value]
+        else:
+            self.counts[value] = count
+        self.size -= 1
+
+    def median(self):
+        """Returns the median of the samples (same result as median())"""
+        if self.size == 0:
+            return numpy.nan
+        # Positions of the middle sample(s) in sorted order
+        upper = self.size / 2
+        lower = upper if self.size % 2 == 1 else upper - 1
+        lower_value = None
+        num_smaller = 0
+        for value in sorted(self.counts):
+            num_smaller += self.counts[value]
+            if lower_value is None and num_smaller > lower:
+                lower_value = value
+            if num_smaller > upper:
+                return (lower_value + value) / 2.0
+
+
+class FenwickTree():
+    """Binary indexed tree over a list of numbers. Supports updating a number
+    and finding the position at which the prefix sums exceed a total in
+    logarithmic time"""
+
+    def __init__(self, size):
+        # tree[i - 1] holds the sum of the numbers at positions
+        # [i - (i & -i), i) of the list (initially a list of size zeros)
+        self.tree = [0] * size
+
+    def add(self, position, value):
+        """Adds the value to the number at the given position"""
+        i = position + 1
+        while i <= len(self.tree):
+            self.tree[i - 1] += value
+            i += i & -i
+
+    def find(self, total):
+        """Returns the first position at which the prefix sum exceeds total
+        (the numbers must not be negative), or the length of the list if there
+        is none"""
+        position = 0
+        step = 1
+        while step * 2 <= len(self.tree):
+            step *= 2
+        while step > 0:
+            i = position + step
+            if i <= len(self.tree) and self.tree[i - 1] <= total:
+                position = i
+                total -= self.tree[i - 1]
+            step //= 2
+        return position
+
+
+class OrderStatistics():
+    """Multiset of numbers taken from a set of values known in advance (e.g. a
+    series of samples that are added one by one). Supports adding a number and
+    selecting the k-th smallest number or a percentile in logarithmic time"""
+
+    def __init__(self, values):
+        # Distinct values in ascending order and their positions, the tree
+        # counts the occurrences of each value in the multiset
+        self.values = sorted(set(values))
+        self.ranks = dict((value, rank)
+                          for rank, value in enumerate(self.values))
+        self.counts = FenwickTree(len(self.values))
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value):
+        self.counts.add(self.ranks[value], 1)
+        self.size += 1
+
+    def select(self, k):
+        """Returns the k-th smallest number (starting at 0)"""
+        return self.values[self.counts.find(k)]
+
+    def percentile(self, nth_percentile):
+        """Returns the same value as percentile() over the numbers, i.e. the
+        linear interpolation between the two closest ranks"""
+        index = nth_percentile / 100.0 * (self.size - 1)
+        below = int(index)
+        above = min(below + 1, self.size - 1)
+        weight_above = index - below
+        return self.select(below) * (1.0 - weight_above) + \
+            self.select(above) * weight_above
+
+
 def mean(lst):
     return numpy.mean(numpy.array(lst))
 